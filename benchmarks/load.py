@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+Load benchmark for tgproxy
+
+Starts a stub Telegram API, runs tgp.py against it with the given server
+options and floods a channel with POST requests. Reports requests/sec and
+latency percentiles.
+
+With --ingest messages go through the line protocol listener instead of
+HTTP. Fire-and-forget load is timed until all messages are queued, --ack
+waits for the answer to every message and reports latencies.
+
+Arguments after "--" are passed to tgp.py:
+pipenv run benchmarks/load.py -n 20000 -c 64
+pipenv run benchmarks/load.py -n 20000 -c 64 -- --uvloop --no-access-log --backlog 1024
+pipenv run benchmarks/load.py --unix-socket /tmp/tgp.sock -- --unix-socket /tmp/tgp.sock
+pipenv run benchmarks/load.py -n 20000 -c 8 --ingest unix
+pipenv run benchmarks/load.py -n 20000 -c 8 --ingest unix --ack
+pipenv run benchmarks/load.py -n 20000 -c 8 --ingest udp
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import aiohttp
+from aiohttp import web
+
+TGP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tgp.py")
+CHANNEL_NAME = "bench"
+STARTUP_TIMEOUT = 10
+INGEST_TIMEOUT = 3
+INGEST_CHUNK_SIZE = 100
+DATAGRAM_LINES = 32
+
+
+class Args(argparse.ArgumentParser):
+    def __init__(self):
+        super().__init__(
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+        self.add_argument("-n", "--requests", dest="requests", type=int, default=10000, help="Total number of requests")
+        self.add_argument("-c", "--concurrency", dest="concurrency", type=int, default=32, help="Number of concurrent clients")
+        self.add_argument("-P", "--port", dest="port", type=int, default=None, help="tgp.py port (random free port by default)")
+        self.add_argument("--unix-socket", dest="unix_socket", default=None, help="Send requests over this Unix domain socket")
+        self.add_argument("--ingest", dest="ingest", choices=["unix", "udp"], default=None, help="Send messages to the line protocol ingest instead of HTTP")
+        self.add_argument("--ack", dest="ack", action="store_true", help="Wait for the ingest answer to every message (unix only)")
+        self.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Show tgp.py logs")
+        self.add_argument("--text", dest="text", default="Benchmark message", help="Message text")
+        self.add_argument("server_args", nargs=argparse.REMAINDER, help="Options for tgp.py after --")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def start_telegram_stub():
+    message_ids = itertools.count(1)
+
+    async def _on_method(request):
+        await request.post()
+        return web.json_response(dict(ok=True, result=dict(message_id=next(message_ids))))
+
+    app = web.Application()
+    app.add_routes([web.post("/{bot}/{method}", _on_method)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def wait_for_server(session, base_url, server):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"tgp.py exited with code {server.returncode}")
+        try:
+            async with session.get(f"{base_url}/ping.html") as resp:
+                if resp.ok:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"tgp.py did not start in {STARTUP_TIMEOUT} seconds")
+
+
+async def run_load(session, url, total, concurrency, text):
+    latencies = []
+    statuses = dict()
+    counter = itertools.count()
+
+    async def _client():
+        while next(counter) < total:
+            started_at = time.perf_counter()
+            async with session.post(url, data=dict(text=text)) as resp:
+                await resp.read()
+            latencies.append(time.perf_counter() - started_at)
+            statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[_client() for _ in range(concurrency)])
+    return time.perf_counter() - started_at, sorted(latencies), statuses
+
+
+async def queued_messages(session, url):
+    async with session.get(url) as resp:
+        return (await resp.json())["queued"]
+
+
+async def wait_for_queued(session, url, total):
+    # Fire-and-forget messages are done when the channel has queued all of them
+    # or nothing is queued for INGEST_TIMEOUT seconds: lost datagrams
+    queued = await queued_messages(session, url)
+    deadline = time.monotonic() + INGEST_TIMEOUT
+    while queued < total and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+        last_queued, queued = queued, await queued_messages(session, url)
+        if queued > last_queued:
+            deadline = time.monotonic() + INGEST_TIMEOUT
+    return queued
+
+
+async def run_ingest_load(session, url, ingest, address, total, concurrency, text, ack):
+    line = f"{CHANNEL_NAME} {urllib.parse.urlencode(dict(text=text, ack=int(ack)))}\n".encode("utf-8")
+    latencies = []
+    statuses = dict()
+    counts = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+
+    async def _stream_client(count):
+        reader, writer = await asyncio.open_unix_connection(address)
+        for sent in range(0, count, 1 if ack else INGEST_CHUNK_SIZE):
+            started_at = time.perf_counter()
+            writer.write(line * (1 if ack else min(INGEST_CHUNK_SIZE, count - sent)))
+            await writer.drain()
+            if ack:
+                status = (await reader.readline()).split(b" ", 1)[0].decode()
+                latencies.append(time.perf_counter() - started_at)
+                statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+        await writer.wait_closed()
+
+    async def _datagram_client(count):
+        # Several lines per datagram: one line datagrams overflow the socket buffer on bursts
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=address)
+        for sent in range(0, count, DATAGRAM_LINES):
+            transport.sendto(line * min(DATAGRAM_LINES, count - sent))
+            await asyncio.sleep(0)
+        transport.close()
+
+    client = _stream_client if ingest == "unix" else _datagram_client
+    started_at = time.perf_counter()
+    await asyncio.gather(*[client(count) for count in counts])
+    queued = await wait_for_queued(session, url, total)
+    elapsed = time.perf_counter() - started_at
+    statuses.setdefault("queued", queued)
+    return elapsed - (INGEST_TIMEOUT if queued < total else 0), sorted(latencies), statuses
+
+
+def print_report(elapsed, latencies, statuses):
+    requests = len(latencies) or statuses.get("queued", 0)
+    print(f"Requests:    {requests}")
+    print(f"Statuses:    {dict(sorted(statuses.items()))}")
+    print(f"Elapsed:     {elapsed:.3f} s")
+    print(f"Requests/s:  {requests / elapsed:.1f}")
+    if latencies:
+        print(f"Latency ms:  mean={statistics.fmean(latencies) * 1000:.2f} p50={percentile(latencies, 50) * 1000:.2f} p90={percentile(latencies, 90) * 1000:.2f} p99={percentile(latencies, 99) * 1000:.2f} max={latencies[-1] * 1000:.2f}")
+
+
+async def main():
+    args = Args().parse_args()
+    server_args = [a for a in args.server_args if a != "--"]
+    port = args.port or free_port()
+
+    if args.ack and args.ingest != "unix":
+        raise SystemExit("--ack works with --ingest unix only")
+    ingest_address = None
+    if args.ingest == "unix":
+        ingest_address = os.path.join(tempfile.mkdtemp(), "ingest.sock")
+        server_args += ["--ingest-unix-socket", ingest_address]
+    elif args.ingest == "udp":
+        ingest_address = ("127.0.0.1", free_port())
+        server_args += ["--ingest-udp", f"{ingest_address[0]}:{ingest_address[1]}"]
+
+    stub_runner, stub_url = await start_telegram_stub()
+    channel_url = f"telegram://bot:token@1/{CHANNEL_NAME}?send_banner_on_startup=0&api_url={stub_url}"
+    server = subprocess.Popen(
+        [sys.executable, TGP_PATH, channel_url, "--host", "127.0.0.1", "--port", str(port), *server_args],
+        stdout=subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    try:
+        connector = aiohttp.UnixConnector(path=args.unix_socket, limit=args.concurrency) if args.unix_socket else aiohttp.TCPConnector(limit=args.concurrency)
+        base_url = f"http://127.0.0.1:{port}"
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await wait_for_server(session, base_url, server)
+            if args.ingest:
+                result = await run_ingest_load(session, f"{base_url}/{CHANNEL_NAME}", args.ingest, ingest_address, args.requests, args.concurrency, args.text, args.ack)
+            else:
+                result = await run_load(session, f"{base_url}/{CHANNEL_NAME}", args.requests, args.concurrency, args.text)
+            print_report(*result)
+    finally:
+        server.terminate()
+        server.wait()
+        await stub_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
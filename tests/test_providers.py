@@ -0,0 +1,116 @@
+import time
+
+import pytest
+from aioresponses import aioresponses
+
+import tgproxy
+from tgproxy.channel import TelegramMessage
+from tgproxy.providers import TelegramBotsPool, TelegramChat
+from tgproxy.providers.errors import ProviderFloodWait
+
+FLOOD_WAIT_PAYLOAD = dict(ok=False, error_code=429, description="Too Many Requests: retry after 30", parameters=dict(retry_after=30))
+
+
+def telegram_url(bot_token, method="sendMessage"):
+    return f"https://api.telegram.org/bot{bot_token}/{method}"
+
+
+def sent_payload(message_id):
+    return dict(ok=True, result=dict(message_id=message_id))
+
+
+def requests_count(m, bot_token, method="sendMessage"):
+    return sum(len(calls) for (_, url), calls in m.requests.items() if str(url) == telegram_url(bot_token, method))
+
+
+@pytest.fixture
+def pool():
+    tgproxy.providers.retry.DEFAULT_RETRY_BUDGET = tgproxy.providers.RetryBudget()
+    return TelegramBotsPool([TelegramChat("chat_1", f"bot{i}:token{i}") for i in range(1, 4)])
+
+
+@pytest.mark.asyncio
+async def test_pool_round_robin_skips_flood_wait(pool):
+    with aioresponses() as m:
+        m.post(telegram_url("bot1:token1"), payload=sent_payload(1), repeat=True)
+        m.post(telegram_url("bot2:token2"), status=429, payload=FLOOD_WAIT_PAYLOAD)
+        m.post(telegram_url("bot3:token3"), payload=sent_payload(3), repeat=True)
+
+        async with pool.session():
+            for _ in range(4):
+                await pool.send_message(TelegramMessage("Test message"))
+
+        assert requests_count(m, "bot1:token1") == 2
+        assert requests_count(m, "bot2:token2") == 1
+        assert requests_count(m, "bot3:token3") == 2
+
+    stat = pool.stat()
+    assert stat["retries"] == 0
+    assert stat["bots"]["bot1"]["sended"] == 2
+    assert stat["bots"]["bot2"]["sended"] == 0
+    assert stat["bots"]["bot2"]["flood_waits"] == 1
+    assert 29 < stat["bots"]["bot2"]["flood_wait"] <= 30
+    assert stat["bots"]["bot3"]["sended"] == 2
+
+
+@pytest.mark.asyncio
+async def test_pool_least_loaded(pool):
+    pool.strategy = "least_loaded"
+    with aioresponses() as m:
+        for i in range(1, 4):
+            m.post(telegram_url(f"bot{i}:token{i}"), payload=sent_payload(i), repeat=True)
+
+        async with pool.session():
+            for _ in range(6):
+                await pool.send_message(TelegramMessage("Test message"))
+
+        assert [requests_count(m, f"bot{i}:token{i}") for i in range(1, 4)] == [2, 2, 2]
+
+
+@pytest.mark.asyncio
+async def test_pool_edits_with_sender_bot(pool):
+    with aioresponses() as m:
+        m.post(telegram_url("bot1:token1"), payload=sent_payload(1))
+        m.post(telegram_url("bot2:token2"), payload=sent_payload(2))
+        m.post(telegram_url("bot2:token2", "editMessageText"), payload=sent_payload(2))
+
+        async with pool.session():
+            await pool.send_message(TelegramMessage("First"))
+            message_id = await pool.send_message(TelegramMessage("Second"))
+            await pool.edit_message(TelegramMessage("Second, edited"), message_id)
+
+        assert requests_count(m, "bot2:token2", "editMessageText") == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_all_bots_in_flood_wait(pool):
+    with aioresponses() as m:
+        for i in range(1, 4):
+            m.post(telegram_url(f"bot{i}:token{i}"), status=429, payload=FLOOD_WAIT_PAYLOAD)
+
+        async with pool.session():
+            with pytest.raises(ProviderFloodWait) as e:
+                await pool.send_message(TelegramMessage("Test message"))
+            assert 29 < e.value.retry_after <= 30
+
+            with pytest.raises(ProviderFloodWait):
+                await pool.send_message(TelegramMessage("Test message"))
+
+        assert sum(requests_count(m, f"bot{i}:token{i}") for i in range(1, 4)) == 3
+
+
+@pytest.mark.asyncio
+async def test_pool_edit_waits_for_sender_bot(pool):
+    with aioresponses() as m:
+        m.post(telegram_url("bot1:token1"), payload=sent_payload(1))
+        m.post(telegram_url("bot1:token1", "editMessageText"), payload=sent_payload(1))
+
+        async with pool.session():
+            message_id = await pool.send_message(TelegramMessage("First"))
+            pool.bots[0].flood_wait_until = time.monotonic() + 30
+            with pytest.raises(ProviderFloodWait) as e:
+                await pool.edit_message(TelegramMessage("First, edited"), message_id)
+            assert 29 < e.value.retry_after <= 30
+
+        # Telegram is not asked while the bot is in flood wait
+        assert requests_count(m, "bot1:token1", "editMessageText") == 0
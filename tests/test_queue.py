@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+import tgproxy.errors as errors
+from tgproxy.channel import Message
+from tgproxy.queue import MemoryBudget, MemoryQueue
+
+
+def _messages(count):
+    return [Message(f"Message {i}", request_id=str(i)) for i in range(count)]
+
+
+async def _drain(queue):
+    return [(await queue.dequeue()).request_id for _ in range(queue.qsize())]
+
+
+@pytest.mark.asyncio
+async def test_rejects_over_maxbytes_without_spill():
+    size = Message("Message 0").size()
+    queue = MemoryQueue(maxbytes=size * 2)
+    for message in _messages(2):
+        await queue.enqueue(message)
+    with pytest.raises(errors.QueueFull):
+        await queue.enqueue(Message("Message 2"))
+    assert queue.qsize() == 2
+
+
+@pytest.mark.asyncio
+async def test_spills_oldest_and_keeps_order(tmp_path):
+    size = Message("Message 0").size()
+    queue = MemoryQueue(maxsize=100, maxbytes=size * 3, spill_dir=str(tmp_path))
+    for message in _messages(10):
+        await queue.enqueue(message)
+
+    assert queue.qsize() == 10
+    assert queue.stat() == {"memory_bytes": size * 3, "disk_size": 7, "spilled": 7}
+    assert queue.head().request_id == "0"
+
+    # New messages go after the spilled ones while the disk part is read
+    assert (await queue.dequeue()).request_id == "0"
+    await queue.enqueue(Message("Message 10", request_id="10"))
+    assert await _drain(queue) == [str(i) for i in range(1, 11)]
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_shared_budget(tmp_path):
+    size = Message("Message 0").size()
+    budget = MemoryBudget(maxbytes=size * 2)
+    first = MemoryQueue(budget=budget, spill_dir=str(tmp_path / "first"))
+    second = MemoryQueue(budget=budget, spill_dir=str(tmp_path / "second"))
+
+    for message in _messages(2):
+        await first.enqueue(message)
+    # The budget is held by the first queue, so the second one writes straight to disk
+    await second.enqueue(Message("Message 2", request_id="2"))
+    assert second.stat()["disk_size"] == 1
+    assert budget.used == size * 2
+
+    assert await _drain(first) == ["0", "1"]
+    assert budget.used == 0
+    assert await _drain(second) == ["2"]
+
+
+@pytest.mark.asyncio
+async def test_spill_segments_rotate(tmp_path):
+    queue = MemoryQueue(maxbytes=1, spill_dir=str(tmp_path))
+    queue._spill.segment_size = 1
+    for message in _messages(5):
+        await queue.enqueue(message)
+    assert len(os.listdir(tmp_path)) == 5
+
+    assert await _drain(queue) == ["0", "1", "2", "3", "4"]
+    assert os.listdir(tmp_path) == []
+
+
+def test_stale_segments_are_removed(tmp_path):
+    (tmp_path / "000000000000.seg").write_bytes(b"garbage")
+    MemoryQueue(spill_dir=str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_iterates_spilled_and_memory_messages(tmp_path):
+    size = Message("Message 0").size()
+    queue = MemoryQueue(maxsize=100, maxbytes=size * 2, spill_dir=str(tmp_path))
+    for message in _messages(6):
+        await queue.enqueue(message)
+    assert (await queue.dequeue()).request_id == "0"
+    assert queue.head().request_id == "1"
+
+    assert [m.request_id for m in queue] == ["1", "2", "3", "4", "5"]
+    assert await _drain(queue) == ["1", "2", "3", "4", "5"]
+
+
+@pytest.mark.asyncio
+async def test_maxsize_limits_memory_with_spill(tmp_path):
+    queue = MemoryQueue(maxsize=2, spill_dir=str(tmp_path))
+    for message in _messages(5):
+        await queue.enqueue(message)
+
+    assert queue.qsize() == 5
+    assert queue.stat()["disk_size"] == 3
+    assert await _drain(queue) == ["0", "1", "2", "3", "4"]
+
+
+@pytest.mark.asyncio
+async def test_charge_counts_toward_limits():
+    size = Message("Message 0").size()
+    budget = MemoryBudget()
+    queue = MemoryQueue(maxsize=100, maxbytes=size * 2, budget=budget)
+    await queue.enqueue(Message("Message 0"))
+    queue.charge(Message("Message 1"))
+    assert budget.used == size * 2
+
+    with pytest.raises(errors.QueueFull):
+        await queue.enqueue(Message("Message 2"))
+    queue.release(Message("Message 1"))
+    await queue.enqueue(Message("Message 2"))
+    assert queue.stat()["memory_bytes"] == size * 2
@@ -0,0 +1,45 @@
+from tgproxy.providers import RetryBudget
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_min_retries_without_successes():
+    budget = RetryBudget(ratio=0.5, min_retries=2, window=10, clock=FakeClock())
+    assert budget.try_retry()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+    assert budget.stat() == {
+        "successes": 0,
+        "retries": 2,
+        "retries_denied": 1,
+    }
+
+
+def test_retries_grow_with_successes():
+    budget = RetryBudget(ratio=0.5, min_retries=0, window=10, clock=FakeClock())
+    assert not budget.try_retry()
+    for _ in range(4):
+        budget.record_success()
+    assert budget.try_retry()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+
+def test_budget_recovers_after_window():
+    clock = FakeClock()
+    budget = RetryBudget(ratio=0, min_retries=1, window=10, clock=clock)
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+    clock.now += 5
+    assert not budget.try_retry()
+
+    clock.now += 5
+    assert budget.try_retry()
+    assert budget.stat()["retries_denied"] == 2
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import pytest
+
+import tgproxy.errors as errors
+from tgproxy.channel import Message
+from tgproxy.scheduler import DEFAULT_SCHEDULER_MAXSIZE, Scheduler
+
+from . import AnyValue
+
+
+class FakeChannel:
+    name = "fake"
+
+    def __init__(self, full_times=0):
+        self.messages = list()
+        self.full_times = full_times
+
+    async def put(self, message):
+        if self.full_times:
+            self.full_times -= 1
+            raise errors.QueueFull("Queue is full")
+        self.messages.append(message.request_id)
+        return message.request_id
+
+
+@pytest.mark.asyncio
+async def test_releases_due_messages_in_order():
+    scheduler = Scheduler()
+    channel = FakeChannel()
+    now = time.time()
+    for request_id, delay in (("3", 0.3), ("1", 0.1), ("2", 0.1), ("4", 60)):
+        scheduler.schedule(channel, Message("Digest", request_id=request_id, send_at=now + delay))
+
+    await scheduler.start()
+    await asyncio.sleep(0.2)
+    assert channel.messages == ["1", "2"]
+    await asyncio.sleep(0.2)
+    assert channel.messages == ["1", "2", "3"]
+    await scheduler.stop()
+
+    assert scheduler.stat() == {
+        "scheduled": 1,
+        "next_send_at": now + 60,
+        "bytes": AnyValue(),
+        "maxsize": DEFAULT_SCHEDULER_MAXSIZE,
+        "maxbytes": None,
+        "released": 3,
+        "delayed": 0,
+        "failed": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_earlier_message_wakes_scheduler():
+    scheduler = Scheduler()
+    channel = FakeChannel()
+    await scheduler.start()
+    scheduler.schedule(channel, Message("Later", request_id="later", delay=60))
+    await asyncio.sleep(0.05)
+    scheduler.schedule(channel, Message("Sooner", request_id="sooner", delay=0.05))
+    await asyncio.sleep(0.15)
+    await scheduler.stop()
+    assert channel.messages == ["sooner"]
+
+
+@pytest.mark.asyncio
+async def test_full_queue_delays_message():
+    scheduler = Scheduler(queue_full_delay=0.1)
+    channel = FakeChannel(full_times=1)
+    scheduler.schedule(channel, Message("Digest", request_id="1", delay=0))
+    await scheduler.start()
+    await asyncio.sleep(0.05)
+    assert channel.messages == []
+    await asyncio.sleep(0.15)
+    await scheduler.stop()
+    assert channel.messages == ["1"]
+    assert scheduler.stat()["delayed"] == 1
+
+
+def test_limits():
+    channel = FakeChannel()
+    scheduler = Scheduler(maxsize=2)
+    for _ in range(2):
+        scheduler.schedule(channel, Message("Digest", delay=60))
+    with pytest.raises(errors.QueueFull):
+        scheduler.schedule(channel, Message("Digest", delay=60))
+
+    scheduler = Scheduler(maxbytes=300)
+    scheduler.schedule(channel, Message("Digest", delay=60))
+    with pytest.raises(errors.QueueFull):
+        scheduler.schedule(channel, Message("Digest" * 100, delay=60))
+    assert 0 < scheduler.stat()["bytes"] <= 300
+
+
+def test_ttl_counts_from_send_at():
+    message = Message("Digest", send_at=2000000000, ttl=60)
+    assert message.expires_at == 2000000060
+    assert message.is_scheduled()
+    with pytest.raises(errors.BadRequest):
+        Message("Digest", delay="tomorrow")
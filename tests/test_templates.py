@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import tgproxy
+from tgproxy.templates import Template, TemplatesRegistry
+
+
+def test_render_without_parse_mode():
+    template = Template("deploy", "{service} deployed to {env} in {duration:.1f}s, {{done}}")
+    assert template.fields == {"service", "env", "duration"}
+    assert template.render(dict(service="api", env="prod", duration=12.345)) == "api deployed to prod in 12.3s, {done}"
+
+
+@pytest.mark.parametrize(
+    "parse_mode, expected",
+    [
+        ("HTML", "<b>a&lt;b&gt; &amp; &quot;c&quot;</b>"),
+        ("MarkdownV2", "*a<b\\> & \"c\"*"),
+    ],
+)
+def test_render_escapes_variables(parse_mode, expected):
+    text = "<b>{value}</b>" if parse_mode == "HTML" else "*{value}*"
+    assert Template("t", text).render(dict(value='a<b> & "c"'), parse_mode=parse_mode) == expected
+
+
+def test_render_escapes_markdown():
+    variables = dict(value="1.5*[x](y)_z!")
+    assert Template("t", "*{value}*").render(variables, parse_mode="MarkdownV2") == "*1\\.5\\*\\[x\\]\\(y\\)\\_z\\!*"
+    assert Template("t", "*{value}*").render(variables, parse_mode="Markdown") == "*1.5\\*\\[x](y)\\_z!*"
+
+
+def test_bad_templates():
+    with pytest.raises(tgproxy.errors.TemplateError):
+        Template("t", "{items[0]}")
+    with pytest.raises(tgproxy.errors.TemplateError):
+        Template("t", "{value")
+
+
+def test_validate():
+    template = Template("t", "{a} {b}", parse_mode="HTML")
+    template.validate(dict(a=1, b=2), "HTML")
+    with pytest.raises(tgproxy.errors.TemplateError, match="variables are not set: b"):
+        template.validate(dict(a=1), "HTML")
+    with pytest.raises(tgproxy.errors.TemplateError, match='Unknown parse_mode "BBCode"'):
+        template.validate(dict(a=1, b=2), "BBCode")
+
+
+def test_registry_lookup_in_parent(tmp_path):
+    path = tmp_path / "templates.json"
+    path.write_text(json.dumps({"local": {"text": "Local {name}", "parse_mode": "HTML"}}))
+
+    parent = TemplatesRegistry([Template("global", "Global {name}"), Template("local", "Overridden")])
+    registry = TemplatesRegistry(parent=parent)
+    registry.load_file(path)
+
+    assert len(registry) == 1
+    assert registry.get("local").parse_mode == "HTML"
+    assert registry.get("global").render(dict(name="x")) == "Global x"
+    with pytest.raises(tgproxy.errors.TemplateError, match='Template "unknown" not found'):
+        registry.get("unknown")
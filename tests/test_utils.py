@@ -17,3 +17,10 @@ def test_parse_url():
         "param1": "value1",
         "timeout": "5",
     }
+
+
+def test_parse_size():
+    assert utils.parse_size("1024") == 1024
+    assert utils.parse_size("512K") == 512 * 1024
+    assert utils.parse_size("64mb") == 64 * 1024**2
+    assert utils.parse_size(1) == 1
@@ -1,7 +1,9 @@
 from tgproxy.app import HttpAPI
 from tgproxy.channel import build_channel
+from tgproxy.ingest import IngestServer
 
 __all__ = [
     "HttpAPI",
+    "IngestServer",
     "build_channel",
 ]
@@ -4,6 +4,10 @@ import logging
 from aiohttp import web
 
 import tgproxy.errors as errors
+import tgproxy.monitoring as monitoring
+import tgproxy.providers.retry as retry
+import tgproxy.queue as queues
+import tgproxy.scheduler as scheduler
 
 DEFAULT_LOGGER_NAME = "tgproxy.app"
 
@@ -54,21 +58,49 @@ class BaseApp:
 
 
 class HttpAPI(BaseApp):
-    def __init__(self, channels):
+    def __init__(self, channels, max_queue_age=None, ingest=None):
         super().__init__()
 
         self.channels = dict(channels)
+        # Optional IngestServer, started and stopped with the app
+        self.ingest = ingest
+        # Ping fails if the oldest queued message is older than max_queue_age seconds
+        self.max_queue_age = max_queue_age
+        self.loop_lag = monitoring.LoopLagMonitor()
+        self.timings = monitoring.StageTimings()
+        self.profiler = monitoring.Profiler()
+        # Releases messages with send_at into the channels queues
+        self.scheduler = scheduler.DEFAULT_SCHEDULER
+        for channel in self.channels.values():
+            channel.scheduler = self.scheduler
+
+        self.app.middlewares.append(self._timing_middleware)
         self.app.add_routes(
             [
                 web.get("/", self._on_index),
+                web.get("/_admin/stats", self._on_admin_stats),
+                web.get("/_admin/profile", self._on_admin_profile),
+                web.get("/_admin/queues/{channel_name}", self._on_admin_queue_peek),
+                web.post("/_admin/queues/{channel_name}/purge", self._on_admin_queue_purge),
+                web.delete("/_admin/queues/{channel_name}/{request_id}", self._on_admin_queue_cancel),
                 web.get("/{channel_name}", self._on_channel_stat),
                 web.post("/{channel_name}", self._on_channel_send),
             ]
         )
+        if self.ingest:
+            # Ingest stops first: it puts messages into the channels
+            self.app.on_shutdown.append(self.ingest.stop)
         self.app.on_startup.append(self.start_background_channels_tasks)
+        self.app.on_startup.append(self.start_monitoring)
+        self.app.on_startup.append(self.scheduler.start)
+        self.app.on_shutdown.append(self.scheduler.stop)
         self.app.on_shutdown.append(self.stop_background_channels_tasks)
+        self.app.on_shutdown.append(self.stop_monitoring)
+        if self.ingest:
+            self.app.on_startup.append(self.ingest.start)
 
         self.background_tasks = list()
+        self._monitoring_task = None
 
     async def start_background_channels_tasks(self, app):
         self._log.info("Start background tasks")
@@ -86,6 +118,24 @@ class HttpAPI(BaseApp):
             task.cancel()
             await task
 
+    async def start_monitoring(self, app):
+        self._monitoring_task = asyncio.create_task(
+            self.loop_lag.run(),
+            name="loop_lag",
+        )
+
+    async def stop_monitoring(self, app):
+        if self._monitoring_task:
+            self._monitoring_task.cancel()
+            await asyncio.gather(self._monitoring_task, return_exceptions=True)
+            self._monitoring_task = None
+
+    @web.middleware
+    async def _timing_middleware(self, request, handler):
+        resource = request.match_info.route.resource
+        with self.timings.measure(f"{request.method} {resource.canonical if resource else '<unknown>'}"):
+            return await handler(request)
+
     def _get_task_state(self, task):
         if task.cancelled():
             return "cancelled"
@@ -99,16 +149,89 @@ class HttpAPI(BaseApp):
     def _workers(self):
         return {task.get_name(): self._get_task_state(task) for task in self.background_tasks}
 
+    def _queues(self):
+        return {name: dict(size=ch.qsize(), oldest_age=ch.oldest_message_age()) for name, ch in self.channels.items()}
+
+    def _stale_queues(self, queues):
+        if self.max_queue_age is None:
+            return []
+        return [name for name, q in queues.items() if q["oldest_age"] is not None and q["oldest_age"] > self.max_queue_age]
+
     async def _on_ping(self, request):
+        queues = self._queues()
         if self._has_failed_workers():
             return self._error_response(
                 status=502,
                 message="Background workers canceled",
                 workers=self._workers(),
+                queues=queues,
+            )
+
+        stale_queues = self._stale_queues(queues)
+        if stale_queues:
+            return self._error_response(
+                status=503,
+                message=f'Queued messages are older than {self.max_queue_age} seconds: {", ".join(stale_queues)}',
+                workers=self._workers(),
+                queues=queues,
             )
 
         return self._success_response(
             workers=self._workers(),
+            queues=queues,
+        )
+
+    async def _on_admin_stats(self, request):
+        return self._success_response(
+            loop_lag=self.loop_lag.stat(),
+            http=self.timings.stat(),
+            channels={name: ch.timings.stat() for name, ch in self.channels.items()},
+            queues={name: ch.queue_stat() for name, ch in self.channels.items()},
+            memory_budget=queues.DEFAULT_MEMORY_BUDGET.stat(),
+            retry_budget=retry.DEFAULT_RETRY_BUDGET.stat(),
+            scheduler=self.scheduler.stat(),
+            **(dict(ingest=self.ingest.stat()) if self.ingest else {}),
+        )
+
+    async def _on_admin_profile(self, request):
+        try:
+            duration = float(request.query.get("duration", 5))
+            slow_callback_duration = float(request.query.get("slow_callback_duration", monitoring.DEFAULT_SLOW_CALLBACK_DURATION))
+            top = int(request.query.get("top", monitoring.DEFAULT_PROFILE_TOP))
+        except ValueError as e:
+            raise errors.BadRequest(f"Bad profile parameters: {e}")
+
+        return self._success_response(
+            profile=await self.profiler.record(duration, slow_callback_duration=slow_callback_duration, top=top),
+        )
+
+    async def _on_admin_queue_peek(self, request):
+        channel = self._get_channel(request)
+        try:
+            limit = int(request.query.get("limit", 10))
+        except ValueError as e:
+            raise errors.BadRequest(f"Bad limit: {e}")
+        if limit < 0:
+            raise errors.BadRequest("Limit must not be negative")
+        return self._success_response(
+            size=channel.qsize(),
+            messages=channel.peek(limit),
+        )
+
+    async def _on_admin_queue_cancel(self, request):
+        channel = self._get_channel(request)
+        await channel.cancel(request.match_info["request_id"])
+        return self._success_response()
+
+    async def _on_admin_queue_purge(self, request):
+        channel = self._get_channel(request)
+        data = await request.post()
+        try:
+            older_than = float(data["older_than"]) if "older_than" in data else None
+        except ValueError as e:
+            raise errors.BadRequest(f"Bad older_than: {e}")
+        return self._success_response(
+            purged=await channel.purge(text=data.get("text"), template=data.get("template"), older_than=older_than),
         )
 
     async def _on_index(self, request):
@@ -128,10 +251,9 @@ class HttpAPI(BaseApp):
         message = channel.message_class.from_request(
             await request.post(),
         )
-        await channel.put(message)
         return self._success_response(
             status=201,
-            request_id=message.request_id,
+            request_id=await channel.put(message),
         )
 
     async def _on_channel_stat(self, request):
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import sys
+
+import aiohttp
+
+import tgproxy.errors as errors
+from tgproxy.queue import MemoryQueue
+
+DEFAULT_LOGGER_NAME = "tgproxy.callbacks"
+DEFAULT_CALLBACK_BATCH_SIZE = 100
+DEFAULT_CALLBACK_BATCH_WINDOW = 1.0
+DEFAULT_CALLBACK_TIMEOUT = 10
+DEFAULT_CALLBACK_ATTEMPTS = 3
+DEFAULT_CALLBACK_RETRY_DELAY = 1
+
+
+class CallbackNotifier:
+    """
+    Posts batched delivery notifications of a channel to the callback url.
+
+    Notifications go through their own queue and worker, so a slow callback
+    endpoint never blocks message sending: when the queue is full, new
+    notifications are dropped. A batch is sent when it has batch_size
+    notifications or batch_window seconds after its first one.
+    """
+
+    def __init__(
+        self,
+        url,
+        channel_name,
+        batch_size=DEFAULT_CALLBACK_BATCH_SIZE,
+        batch_window=DEFAULT_CALLBACK_BATCH_WINDOW,
+        timeout=DEFAULT_CALLBACK_TIMEOUT,
+        attempts=DEFAULT_CALLBACK_ATTEMPTS,
+        queue=None,
+        logger_name=DEFAULT_LOGGER_NAME,
+    ):
+        self.url = url
+        self.channel_name = channel_name
+        self.batch_size = int(batch_size)
+        self.batch_window = float(batch_window)
+        self.attempts = int(attempts)
+        self.http_timeout = aiohttp.ClientTimeout(total=float(timeout))
+
+        self._queue = queue or MemoryQueue(logger_name=f"{logger_name}.queue.{channel_name}")
+        self._log = logging.getLogger(f"{logger_name}.{channel_name}")
+        self._stat = dict(
+            callbacks_sent=0,
+            callbacks_failed=0,
+            callbacks_dropped=0,
+        )
+
+    def stat(self):
+        return dict(self._stat)
+
+    async def notify(self, request_id, status, message_id=None, error=None):
+        event = dict(request_id=request_id, status=status)
+        if message_id is not None:
+            event["message_id"] = message_id
+        if error is not None:
+            event["error"] = error
+
+        try:
+            await self._queue.enqueue(event)
+        except errors.QueueFull:
+            self._stat["callbacks_dropped"] += 1
+            self._log.warning(f"Callback queue is full, drop notification: {event}")
+
+    async def process(self):
+        self._log.info(f"Start callbacks processor for {self.url}")
+        try:
+            # One session for the worker lifetime keeps the connection to the callback url pooled
+            async with aiohttp.ClientSession(timeout=self.http_timeout) as session:
+                while True:
+                    batch = await self._next_batch()
+                    await self._send_batch(session, batch)
+                    for _ in batch:
+                        await self._queue.task_done()
+        except asyncio.CancelledError:
+            self._log.info(f"Finish callbacks processor. Queue size: {self._queue.qsize()}")
+        except Exception as e:
+            self._log.error(str(e), exc_info=sys.exc_info())
+            raise
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.dequeue()]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.dequeue(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _send_batch(self, session, batch):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                async with session.post(self.url, json=dict(channel=self.channel_name, events=batch), allow_redirects=False) as resp:
+                    if resp.ok:
+                        self._stat["callbacks_sent"] += len(batch)
+                        return
+                    error = f"Status: {resp.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or e.__class__.__name__
+
+            self._log.warning(f"Callback failed, attempt {attempt}: {error}")
+            if attempt < self.attempts:
+                await asyncio.sleep(DEFAULT_CALLBACK_RETRY_DELAY * attempt)
+
+        self._stat["callbacks_failed"] += len(batch)
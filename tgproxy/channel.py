@@ -1,17 +1,29 @@
 import asyncio
-import functools
+import collections
+import hashlib
+import itertools
+import json
 import logging
+import os
 import socket
 import sys
 import time
 import uuid
 
+import tgproxy.callbacks as callbacks
 import tgproxy.errors as errors
+import tgproxy.monitoring as monitoring
 import tgproxy.providers as providers
+import tgproxy.queue as queues
+import tgproxy.scheduler as scheduler
+import tgproxy.templates as templates
 import tgproxy.utils as utils
-from tgproxy.queue import MemoryQueue
 
 DEFAULT_LOGGER_NAME = "tgproxy.channel"
+DEFAULT_SENT_MESSAGES_CACHE_SIZE = 10000
+DEFAULT_DEDUP_MAX_KEYS = 10000
+# Rough size of a message object and its attributes besides text and options
+MESSAGE_OVERHEAD_SIZE = 512
 CHANNELS_TYPES = dict()
 
 
@@ -37,19 +49,126 @@ class Message:
     request_fields = {
         "text": {"default": "<Empty message>"},
         "request_id": {},
+        "edit_request_id": {},
+        "template": {},
+        "template_vars": {},
+        "ttl": {},
+        "expires_at": {},
+        "send_at": {},
+        "delay": {},
     }
 
+    # Attributes kept by pickle. Values are pickled without names, so spilled and scheduled messages take less space
+    state_fields = ("text", "request_id", "edit_request_id", "template", "template_vars", "send_at", "expires_at", "options", "queued_at", "dedup_key", "entry_id")
+
     @classmethod
     def from_request(cls, request):
         message = cls(**{f: request.get(f, v.get("default")) for f, v in cls.request_fields.items() if request.get(f, v.get("default")) is not None})
         return message
 
-    def __init__(self, text, request_id=None, **options):
+    def __init__(self, text, request_id=None, edit_request_id=None, template=None, template_vars=None, ttl=None, expires_at=None, send_at=None, delay=None, **options):
         self.text = text
         self.request_id = request_id or str(uuid.uuid1())
+        # request_id of the sent message to edit
+        self.edit_request_id = edit_request_id
+        # Template name and variables. The channel worker renders them into text at dequeue
+        self.template = template
+        self.template_vars = self._parse_template_vars(template_vars)
+        # Unix time when the message is put into the channel queue. ttl counts from it
+        self.send_at = self._parse_send_at(send_at, delay)
+        # Unix time after which the message is dropped unsent
+        self.expires_at = self._parse_expires_at(ttl, expires_at, self.send_at)
         self.options = dict(options)
+        self.queued_at = None
+        # content_key() of a queued message when the channel suppresses duplicates
+        self.dedup_key = None
+        # Number of the channel queue entry. Cancellation marks the entry, not the client supplied request_id
+        self.entry_id = None
+
+    @staticmethod
+    def _parse_send_at(send_at, delay):
+        try:
+            if send_at is not None:
+                return float(send_at)
+            if delay is not None:
+                return time.time() + float(delay)
+        except ValueError as e:
+            raise errors.BadRequest(f"Bad send_at or delay: {e}")
+        return None
+
+    @staticmethod
+    def _parse_expires_at(ttl, expires_at, send_at=None):
+        try:
+            if expires_at is not None:
+                return float(expires_at)
+            if ttl is not None:
+                return (send_at or time.time()) + float(ttl)
+        except ValueError as e:
+            raise errors.BadRequest(f"Bad ttl or expires_at: {e}")
+        return None
+
+    def is_scheduled(self, now=None):
+        return self.send_at is not None and self.send_at > (now or time.time())
+
+    def content_key(self):
+        content = json.dumps([self.text, self.template, self.template_vars, self.options], sort_keys=True, default=str)
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+    def add_repeats_note(self, count):
+        escaper = templates.ESCAPERS.get(self.options.get("parse_mode")) or templates.ESCAPERS[None]
+        self.text = f"{self.text}\n\n{escaper(f'(repeated {count} times)')}"
+
+    def size(self):
+        # Approximate memory held by the queued message
+        variables = len(json.dumps(self.template_vars, default=str)) if self.template_vars else 0
+        return MESSAGE_OVERHEAD_SIZE + sys.getsizeof(self.text) + sum(sys.getsizeof(v) for v in self.options.values()) + variables
+
+    def summary(self):
+        return dict(
+            request_id=self.request_id,
+            text=self.text,
+            template=self.template,
+            edit_request_id=self.edit_request_id,
+            queued_at=self.queued_at,
+            expires_at=self.expires_at,
+        )
+
+    def is_expired(self, now=None):
+        return self.expires_at is not None and (now or time.time()) >= self.expires_at
+
+    @staticmethod
+    def _parse_template_vars(template_vars):
+        if not isinstance(template_vars, str):
+            return template_vars
+        try:
+            template_vars = json.loads(template_vars)
+        except ValueError as e:
+            raise errors.BadRequest(f"template_vars is not a valid JSON: {e}")
+        if not isinstance(template_vars, dict):
+            raise errors.BadRequest("template_vars must be a JSON object")
+        return template_vars
+
+    def validate_template(self, registry):
+        template = registry.get(self.template)
+        template.validate(self.template_vars or {}, self.options.get("parse_mode", template.parse_mode))
+
+    def render(self, registry):
+        if self.template is None:
+            return
+        template = registry.get(self.template)
+        parse_mode = self.options.get("parse_mode", template.parse_mode)
+        self.text = template.render(self.template_vars or {}, parse_mode)
+        if parse_mode is not None:
+            self.options["parse_mode"] = parse_mode
+        self.template = None
+        self.template_vars = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self.state_fields)
+
+    def __setstate__(self, state):
+        self.__dict__.update(zip(self.state_fields, state))
 
-    @functools.cache
     def __repr__(self):
         return f'{self.__class__.__name__}(text="{self.text}", request_id="{self.request_id}", options={self.options})'
 
@@ -62,12 +181,50 @@ class BaseChannel:
     def from_url(cls, url, queue=None, **kwargs):  # pragma: no cover
         raise NotImplementedError()
 
-    def __init__(self, name, queue, provider, send_banner_on_startup=False, logger_name=DEFAULT_LOGGER_NAME, **kwargs):
+    def __init__(
+        self,
+        name,
+        queue,
+        provider,
+        send_banner_on_startup=False,
+        sent_messages_cache_size=DEFAULT_SENT_MESSAGES_CACHE_SIZE,
+        callback_url=None,
+        callback_batch_size=callbacks.DEFAULT_CALLBACK_BATCH_SIZE,
+        callback_batch_window=callbacks.DEFAULT_CALLBACK_BATCH_WINDOW,
+        templates_file=None,
+        message_ttl=None,
+        dedup_window=0,
+        dedup_max_keys=DEFAULT_DEDUP_MAX_KEYS,
+        queue_maxsize=None,
+        queue_maxbytes=None,
+        logger_name=DEFAULT_LOGGER_NAME,
+        **kwargs,
+    ):
         self.name = name
         self.provider = provider
         self.send_banner_on_startup = send_banner_on_startup
-
-        self._queue = queue or MemoryQueue()
+        self.sent_messages_cache_size = int(sent_messages_cache_size)
+        # Default ttl in seconds for messages without ttl or expires_at
+        self.message_ttl = float(message_ttl) if message_ttl else None
+        # Identical messages within dedup_window seconds are folded into the first queued one
+        self.dedup_window = float(dedup_window or 0)
+        self.dedup_max_keys = int(dedup_max_keys)
+        # Holds messages with send_at in the future. HttpAPI sets its own one
+        self.scheduler = scheduler.DEFAULT_SCHEDULER
+        self.callbacks = None
+        if callback_url:
+            self.callbacks = callbacks.CallbackNotifier(
+                callback_url,
+                channel_name=name,
+                batch_size=callback_batch_size,
+                batch_window=callback_batch_window,
+            )
+        # Channel templates override the global ones
+        self.templates = templates.TemplatesRegistry(parent=templates.GLOBAL_TEMPLATES)
+        if templates_file:
+            self.templates.load_file(templates_file)
+
+        self._queue = queue or self._build_queue(queue_maxsize, queue_maxbytes)
         self._log = logging.getLogger(f"{logger_name}.{name}")
         self._stat = dict(
             queued=0,
@@ -76,24 +233,124 @@ class BaseChannel:
             errors=0,
             last_error=None,
             last_error_at=None,
+            coalesced=0,
+            expired=0,
+            suppressed=0,
+            cancelled=0,
         )
         self._retryMessageDelayInSeconds = 5
+        # request_id -> provider message id of the sent messages, LRU
+        self._sent_messages = collections.OrderedDict()
+        # edit_request_id -> (request_id, replacement) of the queued edit of that message.
+        # replacement is the newest edit coalesced into the queue entry, None if the entry itself is the newest
+        self._pending_edits = dict()
+        # content key -> (request_id, entry_id, first seen time) of the queued message, in first seen order
+        self._dedup_index = collections.OrderedDict()
+        # request_id -> number of duplicates folded into the queued message
+        self._repeats = dict()
+        # request_id -> (entry_id of the queue entry, edit_request_id) of the messages waiting to be sent
+        self._queued = dict()
+        # entry_id -> queued_at of the queue entries waiting to be sent, in queue order.
+        # Cancelled entries are removed from it and skipped at dequeue
+        self._waiting = collections.OrderedDict()
+        self._entry_ids = itertools.count()
+        self.timings = monitoring.StageTimings()
 
         self._log.info(f"self.send_banner_on_startup == {self.send_banner_on_startup}")
 
+    def _build_queue(self, maxsize, maxbytes):
+        # Over the byte limits the queue spills to its own directory if spill is on
+        spill_dir = os.path.join(queues.DEFAULT_SPILL_DIR, self.name) if queues.DEFAULT_SPILL_DIR else None
+        return queues.MemoryQueue(
+            maxsize=int(maxsize) if maxsize else None,
+            maxbytes=utils.parse_size(maxbytes) if maxbytes else None,
+            budget=queues.DEFAULT_MEMORY_BUDGET,
+            spill_dir=spill_dir,
+            logger_name=f"{queues.DEFAULT_LOGGER_NAME}.{self.name}",
+        )
+
     def qsize(self):
-        return self._queue.qsize()
+        return len(self._waiting)
+
+    def queue_stat(self):
+        return self._queue.stat() if hasattr(self._queue, "stat") else {}
+
+    def oldest_message_age(self):
+        if not self._waiting:
+            return None
+        return round(time.time() - next(iter(self._waiting.values())), 3)
 
     def stat(self):
         return dict(
             filter(
                 lambda x: x[1] is not None,
-                self._stat.items(),
+                (self._stat | self.provider.stat() | (self.callbacks.stat() if self.callbacks else {})).items(),
             ),
         )
 
     async def put(self, message):
-        await self._enqueue(message)
+        # Returns request_id of the queued message. It differs from message.request_id if the message is folded into a duplicate
+        with self.timings.measure("enqueue"):
+            if message.template is not None:
+                message.validate_template(self.templates)
+            if message.is_scheduled():
+                self.scheduler.schedule(self, message)
+                return message.request_id
+            if message.expires_at is None and self.message_ttl:
+                message.expires_at = time.time() + self.message_ttl
+            if message.edit_request_id is not None:
+                await self._enqueue_edit(message)
+            elif self.dedup_window:
+                return await self._enqueue_deduplicated(message)
+            else:
+                await self._enqueue(message)
+            return message.request_id
+
+    def peek(self, limit=10):
+        # The oldest messages waiting to be sent
+        return [message.summary() for message in itertools.islice(self._waiting_messages(), limit)]
+
+    async def cancel(self, request_id):
+        entry = self._queued.pop(request_id, None)
+        if entry is None:
+            raise errors.MessageNotFound(f'Message "{request_id}" is not queued')
+
+        entry_id, edit_request_id = entry
+        if edit_request_id is not None:
+            self._forget_pending_edit(edit_request_id)
+        # The queue entry stays in place and is dropped by the worker
+        del self._waiting[entry_id]
+        self._queue.mark_cancelled()
+        self._repeats.pop(request_id, None)
+        self._stat["cancelled"] += 1
+        self._log.info(f"Cancel message {request_id}")
+        if self.callbacks:
+            await self.callbacks.notify(request_id, "cancelled")
+
+    async def purge(self, text=None, template=None, older_than=None):
+        # Cancels waiting messages that match all the given filters. Returns the number of cancelled messages
+        if text is None and template is None and older_than is None:
+            raise errors.BadRequest("Purge needs at least one filter: text, template or older_than")
+
+        now = time.time()
+        request_ids = [
+            m.request_id
+            for m in self._waiting_messages()
+            if (text is None or text in (m.text or ""))
+            and (template is None or m.template == template)
+            and (older_than is None or now - m.queued_at > older_than)
+        ]
+        for request_id in request_ids:
+            await self.cancel(request_id)
+        return len(request_ids)
+
+    def _waiting_messages(self):
+        for message in self._queue:
+            if message.entry_id not in self._waiting:
+                continue
+            if message.edit_request_id is not None:
+                message = self._pending_edits[message.edit_request_id][1] or message
+            yield message
 
     async def process(self):
         self._log.info(f"Start queue processor for {self}")
@@ -101,17 +358,12 @@ class BaseChannel:
             await self.put(self._get_banner())
 
         async with self.provider.session() as provider:
+            callbacks_task = None
+            if self.callbacks:
+                callbacks_task = asyncio.create_task(self.callbacks.process(), name=f"{self.name}.callbacks")
             try:
                 while True:
-                    message = await self._dequeue()
-
-                    self._log.info(f"Send message: {message}")
-                    while True:
-                        error = await self._send_message(provider, message)
-                        if error is None or isinstance(error, providers.errors.ProviderFatalError):
-                            break
-                        await asyncio.sleep(self._retryMessageDelayInSeconds)
-
+                    await self._process_message(provider, await self._dequeue())
                     await self._queue.task_done()
             except asyncio.CancelledError:
                 self._log.info(f"Finish queue processor. Queue size: {self._queue.qsize()}")
@@ -119,12 +371,154 @@ class BaseChannel:
                 self._log.error(str(e), exc_info=sys.exc_info())
                 self._log.info(f"Failed queue processor. Queue size: {self._queue.qsize()}")
                 raise
+            finally:
+                if callbacks_task:
+                    callbacks_task.cancel()
+                    await asyncio.gather(callbacks_task, return_exceptions=True)
+
+    async def _process_message(self, provider, message):
+        message = self._take_entry(message)
+        if message is None:
+            return
+        repeats = self._forget_duplicates(message)
+
+        if message.is_expired():
+            await self._expire(message)
+            return
+
+        try:
+            message.render(self.templates)
+        except errors.TemplateError as e:
+            self._register_error(e, message)
+            await self._notify(message, e)
+            return
+        if repeats:
+            message.add_repeats_note(repeats + 1)
+
+        self._log.info(f"Send message: {message}")
+        with self.timings.measure("send"):
+            while True:
+                error = await self._send_message(provider, message)
+                if error is None or isinstance(error, providers.errors.ProviderFatalError):
+                    break
+                await asyncio.sleep(getattr(error, "retry_after", None) or self._retryMessageDelayInSeconds)
+                if message.is_expired():
+                    await self._expire(message)
+                    return
+
+        await self._notify(message, error)
+
+    def _take_entry(self, message):
+        # Returns the message to send for the dequeued entry or None if the entry is cancelled
+        if message.entry_id not in self._waiting:
+            self._queue.drop_cancelled()
+            self._forget_dedup_key(message)
+            return None
+
+        self.timings.record("queue_wait", time.time() - message.queued_at)
+        entry_id = message.entry_id
+        del self._waiting[entry_id]
+        if message.edit_request_id is not None:
+            message = self._forget_pending_edit(message.edit_request_id) or message
+        if self._queued.get(message.request_id, (None,))[0] == entry_id:
+            del self._queued[message.request_id]
+        return message
+
+    async def _expire(self, message):
+        # Expired messages are dropped without a provider call
+        self._log.info(f"Drop expired message: {message}")
+        self._stat["expired"] += 1
+        if self.callbacks:
+            await self.callbacks.notify(message.request_id, "expired")
+
+    async def _notify(self, message, error=None):
+        if not self.callbacks:
+            return
+        if error is None:
+            await self.callbacks.notify(message.request_id, "delivered", message_id=self._sent_messages.get(message.request_id))
+        else:
+            await self.callbacks.notify(message.request_id, "failed", error=str(error))
 
     async def _enqueue(self, message):
         self._log.info(f"Enque message: {message}")
+        message.queued_at = time.time()
+        message.entry_id = next(self._entry_ids)
         await self._queue.enqueue(message)
+        self._queued[message.request_id] = (message.entry_id, message.edit_request_id)
+        self._waiting[message.entry_id] = message.queued_at
         self._stat["queued"] += 1
 
+    async def _enqueue_edit(self, message):
+        # Only the newest edit of a message is sent: a queued edit is replaced, not queued again
+        pending = self._pending_edits.get(message.edit_request_id)
+        if pending is not None:
+            self._log.info(f"Coalesce edit: {message}")
+            previous_request_id, previous = pending
+            # The replacement is kept in memory until the queue entry is dequeued
+            self._queue.charge(message)
+            if previous is not None:
+                self._queue.release(previous)
+            entry = self._queued.pop(previous_request_id)
+            message.entry_id = entry[0]
+            message.queued_at = self._waiting[message.entry_id]
+            self._queued[message.request_id] = entry
+            self._pending_edits[message.edit_request_id] = (message.request_id, message)
+            self._stat["coalesced"] += 1
+            if self.callbacks:
+                # The replaced edit is never sent
+                await self.callbacks.notify(previous_request_id, "coalesced")
+            return
+
+        await self._enqueue(message)
+        self._pending_edits[message.edit_request_id] = (message.request_id, None)
+
+    def _forget_pending_edit(self, edit_request_id):
+        # Returns the replacement of the queued edit, if any
+        _, replacement = self._pending_edits.pop(edit_request_id)
+        if replacement is not None:
+            self._queue.release(replacement)
+        return replacement
+
+    async def _enqueue_deduplicated(self, message):
+        now = time.time()
+        self._evict_dedup_keys(now)
+
+        key = message.content_key()
+        entry = self._dedup_index.get(key)
+        if entry is not None and entry[1] in self._waiting:
+            request_id = entry[0]
+            self._log.info(f"Suppress duplicate of {request_id}: {message}")
+            self._repeats[request_id] = self._repeats.get(request_id, 0) + 1
+            self._stat["suppressed"] += 1
+            return request_id
+
+        # Set before enqueue: a spilled message is stored as it is at enqueue
+        message.dedup_key = key
+        await self._enqueue(message)
+        # A key of a cancelled message is moved to the end to keep the first seen order
+        self._dedup_index.pop(key, None)
+        self._dedup_index[key] = (message.request_id, message.entry_id, now)
+        return message.request_id
+
+    def _evict_dedup_keys(self, now):
+        # Keys are in first seen order, so only the oldest ones are checked
+        while self._dedup_index:
+            _, (_, _, first_seen) = next(iter(self._dedup_index.items()))
+            if first_seen + self.dedup_window > now and len(self._dedup_index) < self.dedup_max_keys:
+                break
+            self._dedup_index.popitem(last=False)
+
+    def _forget_duplicates(self, message):
+        # Returns the number of duplicates folded into the dequeued message
+        self._forget_dedup_key(message)
+        return self._repeats.pop(message.request_id, 0)
+
+    def _forget_dedup_key(self, message):
+        if message.dedup_key is not None:
+            entry = self._dedup_index.get(message.dedup_key)
+            if entry is not None and entry[1] == message.entry_id:
+                del self._dedup_index[message.dedup_key]
+
     async def _dequeue(self):
         message = await self._queue.dequeue()
         self._log.info(f"Deque message: {message}")
@@ -138,24 +532,49 @@ class BaseChannel:
     async def _send_message(self, provider, message):
         # return Exception if failed
         try:
-            await provider.send_message(message)
+            if message.edit_request_id is not None:
+                message_id = self._sent_messages.get(message.edit_request_id)
+                if message_id is None:
+                    raise providers.errors.ProviderFatalError(f'Message with request_id "{message.edit_request_id}" was not sent or is forgotten')
+                await provider.edit_message(message, message_id)
+            else:
+                message_id = await provider.send_message(message)
+            self._remember_message_id(message.request_id, message_id)
             self._log.info(f"Message sended: {message}")
             self._stat["sended"] += 1
             self._stat["last_sended_at"] = round(time.time(), 3)
         except providers.errors.ProviderError as e:
-            self._stat["errors"] += 1
-            self._stat["last_error"] = str(e)
-            self._stat["last_error_at"] = round(time.time(), 3)
-            self._log.error(f"Error: {str(e)} Message: {message}", exc_info=sys.exc_info())
+            self._register_error(e, message)
             return e
 
         return None
 
+    def _register_error(self, error, message):
+        self._stat["errors"] += 1
+        self._stat["last_error"] = str(error)
+        self._stat["last_error_at"] = round(time.time(), 3)
+        self._log.error(f"Error: {str(error)} Message: {message}", exc_info=sys.exc_info())
+
+    def _remember_message_id(self, request_id, message_id):
+        if message_id is None:
+            return
+        self._sent_messages[request_id] = message_id
+        self._sent_messages.move_to_end(request_id)
+        if len(self._sent_messages) > self.sent_messages_cache_size:
+            self._sent_messages.popitem(last=False)
+
 
 class TelegramMessage(Message):
     request_fields = {
         "text": {"default": "<Empty message>"},
         "request_id": {},
+        "edit_request_id": {},
+        "template": {},
+        "template_vars": {},
+        "ttl": {},
+        "expires_at": {},
+        "send_at": {},
+        "delay": {},
         "parse_mode": {},
         "disable_web_page_preview": {"default": 0},
         "disable_notifications": {"default": 0},
@@ -170,7 +589,21 @@ class TelegramChannel(BaseChannel):
     @classmethod
     def from_url(cls, url, queue=None, **kwargs):
         parsed_url, options = utils.parse_url(url)
-        return cls(name=parsed_url.path.strip("/"), queue=queue, provider=providers.TelegramChat(chat_id=parsed_url.hostname, bot_token=f"{parsed_url.username}:{parsed_url.password}", **(options | kwargs)), **(options | kwargs))
+        return cls(name=parsed_url.path.strip("/"), queue=queue, provider=cls._build_provider(parsed_url, **(options | kwargs)), **(options | kwargs))
+
+    @staticmethod
+    def _build_provider(parsed_url, pool_bots=None, pool_strategy="round_robin", **options):
+        # pool_bots: comma separated tokens of more bots in the same chat
+        bot_token = f"{parsed_url.username}:{parsed_url.password}"
+        if not pool_bots:
+            return providers.TelegramChat(chat_id=parsed_url.hostname, bot_token=bot_token, **options)
+
+        tokens = [bot_token] + [t.strip() for t in pool_bots.split(",") if t.strip()]
+        return providers.TelegramBotsPool(
+            [providers.TelegramChat(chat_id=parsed_url.hostname, bot_token=t, **options) for t in tokens],
+            strategy=pool_strategy,
+            **options,
+        )
 
     def __init__(self, name, queue, provider, send_banner_on_startup=True, **kwargs):
         super().__init__(name, queue, provider, send_banner_on_startup=bool(int(send_banner_on_startup)), **kwargs)
@@ -180,11 +613,16 @@ class TelegramChannel(BaseChannel):
         self._channel_options = dict(kwargs)
 
     def __str__(self):
-        co = [f"{k}={v}" for k, v in self._channel_options.items()]
+        co = [f"{k}={self._mask_option(k, v)}" for k, v in self._channel_options.items()]
         co = f'{"&".join(co)}'
         if co:
             co = f"?{co}"
         return f"{self.schema}://{self._bot_name}:***@{self._chat_id}/{self.name}{co}"
 
+    def _mask_option(self, name, value):
+        if name == "pool_bots":
+            return ",".join(f'{t.strip()[: t.strip().find(":")]}:***' for t in value.split(",") if t.strip())
+        return value
+
 
 register_channel_type(TelegramChannel)
@@ -12,3 +12,19 @@ class QueueFull(BaseError):
 
 class ChannelNotFound(BaseError):
     http_status = 404
+
+
+class MessageNotFound(BaseError):
+    http_status = 404
+
+
+class BadRequest(BaseError):
+    http_status = 400
+
+
+class ProfilerBusy(BaseError):
+    http_status = 409
+
+
+class TemplateError(BadRequest):
+    pass
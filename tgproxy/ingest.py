@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import socket
+import sys
+import urllib.parse
+
+import tgproxy.errors as errors
+
+DEFAULT_LOGGER_NAME = "tgproxy.ingest"
+DEFAULT_DATAGRAMS_QUEUE_MAXSIZE = 10000
+MAX_LINE_SIZE = 64 * 1024
+UDP_RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+ACK_FIELD = "ack"
+
+
+class IngestServer:
+    """
+    Low overhead listener for local producers.
+
+    One message per line: the channel name, a space and urlencoded message
+    fields, the same fields as in the HTTP API:
+
+        alerts text=Disk+is+full&parse_mode=HTML
+
+    Messages are fire-and-forget. With ack=1 in the fields the server
+    answers "OK <request_id>" or "ERR <http status> <message>" on the same
+    connection or to the sender of the datagram.
+    """
+
+    def __init__(self, channels, unix_socket=None, udp_host=None, udp_port=None, logger_name=DEFAULT_LOGGER_NAME):
+        self.channels = channels
+        self.unix_socket = unix_socket
+        self.udp_host = udp_host
+        self.udp_port = udp_port
+        # Bound (host, port) of the UDP listener after start
+        self.udp_address = None
+
+        self._log = logging.getLogger(logger_name)
+        self._unix_server = None
+        self._udp_transport = None
+        self._datagrams = asyncio.Queue(maxsize=DEFAULT_DATAGRAMS_QUEUE_MAXSIZE)
+        self._datagrams_task = None
+        self._stat = dict(
+            received=0,
+            errors=0,
+            datagrams_dropped=0,
+        )
+
+    def stat(self):
+        return dict(self._stat)
+
+    async def start(self, app=None):
+        if self.unix_socket:
+            self._log.info(f"Listen unix socket {self.unix_socket}")
+            self._unix_server = await asyncio.start_unix_server(self._on_connection, path=self.unix_socket, limit=MAX_LINE_SIZE)
+        if self.udp_port is not None:
+            self._log.info(f"Listen udp {self.udp_host}:{self.udp_port}")
+            self._udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _DatagramProtocol(self),
+                local_addr=(self.udp_host, int(self.udp_port)),
+            )
+            self.udp_address = self._udp_transport.get_extra_info("sockname")
+            self._set_receive_buffer(self._udp_transport.get_extra_info("socket"))
+            self._datagrams_task = asyncio.create_task(self._process_datagrams(), name="ingest.udp")
+
+    async def stop(self, app=None):
+        if self._unix_server:
+            self._unix_server.close()
+            await self._unix_server.wait_closed()
+            self._unix_server = None
+        if self._udp_transport:
+            self._udp_transport.close()
+            self._udp_transport = None
+        if self._datagrams_task:
+            self._datagrams_task.cancel()
+            await asyncio.gather(self._datagrams_task, return_exceptions=True)
+            self._datagrams_task = None
+
+    async def put_line(self, line):
+        # Returns (ack requested, ack line)
+        self._stat["received"] += 1
+        ack = False
+        try:
+            name, _, fields = line.decode("utf-8").strip().partition(" ")
+            fields = dict(urllib.parse.parse_qsl(fields, keep_blank_values=True))
+            ack = fields.pop(ACK_FIELD, "0") not in ("", "0")
+
+            channel = self.channels.get(name)
+            if not channel:
+                raise errors.ChannelNotFound(f'Channel "{name}" not found')
+            message = channel.message_class.from_request(fields)
+            return ack, f"OK {await channel.put(message)}\n"
+        except UnicodeDecodeError as e:
+            return ack, self._error_line(400, f"Bad encoding: {e}")
+        except errors.BaseError as e:
+            return ack, self._error_line(e.http_status, str(e))
+        except Exception as e:
+            self._log.error(str(e), exc_info=sys.exc_info())
+            return ack, self._error_line(500, str(e))
+
+    def _error_line(self, status, message):
+        self._stat["errors"] += 1
+        self._log.warning(f"Ingest error {status}: {message}")
+        return f"ERR {status} {message}\n"
+
+    async def _on_connection(self, reader, writer):
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                ack, reply = await self.put_line(line)
+                if ack:
+                    writer.write(reply.encode("utf-8"))
+                    await writer.drain()
+        except (ValueError, ConnectionError) as e:
+            # ValueError: the line is longer than MAX_LINE_SIZE
+            self._stat["errors"] += 1
+            self._log.warning(f"Close ingest connection: {e}")
+        finally:
+            writer.close()
+
+    def _set_receive_buffer(self, sock):
+        # Datagrams that do not fit the socket buffer on bursts are lost. The kernel may cap the size (net.core.rmem_max)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER_SIZE)
+        except OSError as e:
+            self._log.warning(f"Can't set UDP receive buffer size: {e}")
+
+    def _on_datagram(self, data, addr):
+        try:
+            self._datagrams.put_nowait((data, addr))
+        except asyncio.QueueFull:
+            self._stat["datagrams_dropped"] += 1
+
+    async def _process_datagrams(self):
+        while True:
+            data, addr = await self._datagrams.get()
+            for line in data.splitlines():
+                if not line.strip():
+                    continue
+                ack, reply = await self.put_line(line)
+                if ack and self._udp_transport:
+                    self._udp_transport.sendto(reply.encode("utf-8"), addr)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self._server = server
+
+    def datagram_received(self, data, addr):
+        self._server._on_datagram(data, addr)
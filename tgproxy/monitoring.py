@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import cProfile
+import logging
+import pstats
+import time
+
+import tgproxy.errors as errors
+
+DEFAULT_LAG_INTERVAL = 0.25
+DEFAULT_LAG_SMOOTHING = 0.1
+DEFAULT_SLOW_CALLBACK_DURATION = 0.1
+DEFAULT_PROFILE_TOP = 20
+MAX_PROFILE_DURATION = 60
+SLOW_CALLBACK_MESSAGE_PREFIX = "Executing "
+
+
+class LoopLagMonitor:
+    # Samples event loop lag: how late a sleep(interval) wakes up
+    def __init__(self, interval=DEFAULT_LAG_INTERVAL, smoothing=DEFAULT_LAG_SMOOTHING):
+        self.interval = interval
+        self.smoothing = smoothing
+        self._stat = dict(
+            samples=0,
+            last=0.0,
+            avg=0.0,
+            max=0.0,
+        )
+
+    def stat(self):
+        return {k: round(v, 6) if isinstance(v, float) else v for k, v in self._stat.items()}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(self.interval)
+            self._record(max(0.0, loop.time() - started_at - self.interval))
+
+    def _record(self, lag):
+        s = self._stat
+        s["avg"] = lag if s["samples"] == 0 else s["avg"] + self.smoothing * (lag - s["avg"])
+        s["samples"] += 1
+        s["last"] = lag
+        s["max"] = max(s["max"], lag)
+
+
+class StageTimings:
+    # Per-stage counters of durations. Hooks are called as hook(stage, duration) on every record.
+    def __init__(self):
+        self.hooks = list()
+        self._stages = dict()
+
+    def record(self, stage, duration):
+        s = self._stages.get(stage)
+        if s is None:
+            s = self._stages[stage] = [0, 0.0, 0.0]
+        s[0] += 1
+        s[1] += duration
+        s[2] = max(s[2], duration)
+        for hook in self.hooks:
+            hook(stage, duration)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started_at)
+
+    def stat(self):
+        return {
+            stage: dict(
+                count=count,
+                total=round(total, 6),
+                avg=round(total / count, 6),
+                max=round(max_, 6),
+            )
+            for stage, (count, total, max_) in self._stages.items()
+        }
+
+
+class _SlowCallbacksHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.callbacks = list()
+
+    def emit(self, record):
+        # asyncio debug mode logs: "Executing <Handle ...> took 0.123 seconds"
+        if isinstance(record.msg, str) and record.msg.startswith(SLOW_CALLBACK_MESSAGE_PREFIX) and len(record.args) == 2:
+            self.callbacks.append(
+                dict(
+                    callback=str(record.args[0]),
+                    duration=round(record.args[1], 6),
+                ),
+            )
+
+
+class Profiler:
+    """
+    Records a time-bounded profile of the event loop thread.
+
+    Slow callbacks are collected from the asyncio debug mode, which is
+    switched on only while the profile runs. Coroutines and functions are
+    ranked by cProfile cumulative time.
+    """
+
+    def __init__(self):
+        self._running = False
+
+    async def record(self, duration, slow_callback_duration=DEFAULT_SLOW_CALLBACK_DURATION, top=DEFAULT_PROFILE_TOP):
+        if not 0 < duration <= MAX_PROFILE_DURATION:
+            raise errors.BadRequest(f"Profile duration must be in (0, {MAX_PROFILE_DURATION}] seconds")
+        if self._running:
+            raise errors.ProfilerBusy("Profiler is already running")
+
+        loop = asyncio.get_running_loop()
+        asyncio_log = logging.getLogger("asyncio")
+        handler = _SlowCallbacksHandler()
+        profile = cProfile.Profile()
+        debug, slow_duration = loop.get_debug(), loop.slow_callback_duration
+
+        self._running = True
+        try:
+            loop.set_debug(True)
+            loop.slow_callback_duration = slow_callback_duration
+            asyncio_log.addHandler(handler)
+            profile.enable()
+            await asyncio.sleep(duration)
+        finally:
+            profile.disable()
+            asyncio_log.removeHandler(handler)
+            loop.slow_callback_duration = slow_duration
+            loop.set_debug(debug)
+            self._running = False
+
+        return dict(
+            duration=duration,
+            slow_callbacks=sorted(handler.callbacks, key=lambda x: x["duration"], reverse=True)[:top],
+            top=self._top_functions(profile, top),
+        )
+
+    def _top_functions(self, profile, top):
+        stats = pstats.Stats(profile).stats
+        ranked = sorted(stats.items(), key=lambda x: x[1][3], reverse=True)[:top]
+        return [
+            dict(
+                function=f"{file}:{line}({name})",
+                calls=ncalls,
+                tottime=round(tottime, 6),
+                cumtime=round(cumtime, 6),
+            )
+            for (file, line, name), (_, ncalls, tottime, cumtime, _) in ranked
+        ]
@@ -1,5 +1,8 @@
-from .telegram import TelegramChat
+from .retry import RetryBudget
+from .telegram import TelegramBotsPool, TelegramChat
 
 __all__ = [
+    'RetryBudget',
+    'TelegramBotsPool',
     'TelegramChat',
 ]
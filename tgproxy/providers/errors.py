@@ -8,5 +8,15 @@ class ProviderFatalError(ProviderError):
 
 
 class ProviderTemporaryError(ProviderError):
+    # Seconds the caller should wait before sending again, None if up to the caller
+    retry_after = None
+
     def __init__(self, source=None, *args, **kwargs):
         super().__init__(f"telegram temporary error: {source}" if source is not None else None, *args, **kwargs)
+
+
+class ProviderFloodWait(ProviderTemporaryError):
+    # The bot hit the rate limit and must not call the API for retry_after seconds
+    def __init__(self, source=None, retry_after=0, *args, **kwargs):
+        super().__init__(source, *args, **kwargs)
+        self.retry_after = retry_after
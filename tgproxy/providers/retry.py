@@ -0,0 +1,66 @@
+import time
+
+DEFAULT_RETRY_BUDGET_RATIO = 0.2
+DEFAULT_RETRY_BUDGET_MIN_RETRIES = 10
+DEFAULT_RETRY_BUDGET_WINDOW = 10
+WINDOW_BUCKETS = 10
+
+
+class RetryBudget:
+    """
+    Process-wide retry budget shared by all providers.
+
+    A retry is allowed while the number of retries in the sliding window
+    stays below ratio * successful calls + min_retries. The window is kept
+    in a fixed ring of buckets, so every check is O(1).
+    """
+
+    def __init__(self, ratio=DEFAULT_RETRY_BUDGET_RATIO, min_retries=DEFAULT_RETRY_BUDGET_MIN_RETRIES, window=DEFAULT_RETRY_BUDGET_WINDOW, clock=time.monotonic):
+        self.ratio = float(ratio)
+        self.min_retries = int(min_retries)
+        self.window = float(window)
+
+        self._clock = clock
+        self._bucket_width = self.window / WINDOW_BUCKETS
+        self._bucket = int(self._clock() // self._bucket_width)
+        self._successes = [0] * WINDOW_BUCKETS
+        self._retries = [0] * WINDOW_BUCKETS
+        self._stat = dict(
+            successes=0,
+            retries=0,
+            retries_denied=0,
+        )
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(ratio={self.ratio}, min_retries={self.min_retries}, window={self.window})"
+
+    def record_success(self):
+        self._successes[self._current_bucket()] += 1
+        self._stat["successes"] += 1
+
+    def try_retry(self):
+        # Returns True and spends one retry if the budget allows it
+        bucket = self._current_bucket()
+        if sum(self._retries) >= self.ratio * sum(self._successes) + self.min_retries:
+            self._stat["retries_denied"] += 1
+            return False
+
+        self._retries[bucket] += 1
+        self._stat["retries"] += 1
+        return True
+
+    def stat(self):
+        return dict(self._stat)
+
+    def _current_bucket(self):
+        bucket = int(self._clock() // self._bucket_width)
+        if bucket != self._bucket:
+            # Clear buckets that left the window since the last call
+            for b in range(max(self._bucket + 1, bucket - WINDOW_BUCKETS + 1), bucket + 1):
+                self._successes[b % WINDOW_BUCKETS] = 0
+                self._retries[b % WINDOW_BUCKETS] = 0
+            self._bucket = bucket
+        return bucket % WINDOW_BUCKETS
+
+
+DEFAULT_RETRY_BUDGET = RetryBudget()
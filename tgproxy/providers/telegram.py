@@ -1,23 +1,35 @@
 import asyncio
+import collections
 import contextlib
+import json
 import logging
+import random
+import time
 
 import aiohttp
-import tenacity
 
-from .errors import ProviderError, ProviderFatalError, ProviderTemporaryError
+from . import retry
+from .errors import (ProviderError, ProviderFatalError, ProviderFloodWait,
+                     ProviderTemporaryError)
 
 TELEGRAM_API_URL = "https://api.telegram.org"
 DEFAULT_LOGGER_NAME = "tgproxy.providers.telegram"
 DEFAULT_TELEGRAM_TIMEOUT = 25
+DEFAULT_FLOOD_WAIT = 5
+DEFAULT_POOL_MESSAGES_CACHE_SIZE = 10000
 
 DEFAULT_RETRIES_OPTIONS = dict(
-    stop=tenacity.stop_after_attempt(15),
-    wait=tenacity.wait_random_exponential(
-        multiplier=1,
-        min=2,
-        max=120,
-    ),
+    attempts=15,
+    wait_multiplier=1,
+    wait_min=2,
+    wait_max=120,
+)
+
+TELEGRAM_MESSAGE_NOT_MODIFIED = "message is not modified"
+EDIT_MESSAGE_METHOD = "editMessageText"
+EDIT_MESSAGE_OPTIONS = (
+    "parse_mode",
+    "disable_web_page_preview",
 )
 
 TELEGRAM_TEMPORARY_ERRORS = (
@@ -30,7 +42,7 @@ TELEGRAM_TEMPORARY_ERRORS = (
 
 
 class TelegramChat:
-    def __init__(self, chat_id, bot_token, api_url=TELEGRAM_API_URL, timeout=DEFAULT_TELEGRAM_TIMEOUT, logger_name=DEFAULT_LOGGER_NAME, **kwargs):
+    def __init__(self, chat_id, bot_token, api_url=TELEGRAM_API_URL, timeout=DEFAULT_TELEGRAM_TIMEOUT, retry_budget=None, logger_name=DEFAULT_LOGGER_NAME, **kwargs):
         self.chat_id = chat_id
         self.bot_token = bot_token
         self.bot_name = self.bot_token[: self.bot_token.find(":")]
@@ -44,18 +56,42 @@ class TelegramChat:
         self.http_timeout = aiohttp.ClientTimeout(total=self.timeout)
         self._http_client = None
 
-        self._retries_options = dict(
-            **DEFAULT_RETRIES_OPTIONS,
-            retry=tenacity.retry_if_exception_type(ProviderTemporaryError),
-            after=tenacity.after_log(self._log, logging.WARNING),
+        self._retries_options = dict(DEFAULT_RETRIES_OPTIONS)
+        self.retry_budget = retry_budget or retry.DEFAULT_RETRY_BUDGET
+        # time.monotonic() until which Telegram asked the bot not to send requests
+        self.flood_wait_until = 0
+        # Sends given up without a success in between. The delay before the next send grows with it
+        self._give_ups = 0
+        self._stat = dict(
+            retries=0,
+            retries_denied=0,
         )
 
+    def stat(self):
+        return dict(self._stat)
+
+    def flood_wait_remaining(self):
+        return max(0, self.flood_wait_until - time.monotonic())
+
     async def send_message(self, message):
+        # Returns Telegram message_id of the sent message
         self._log.info(f"Send message {message}")
-        await self._request(
+        _, data = await self._request(
             "sendMessage",
             request_data=dict(text=message.text, **message.options),
         )
+        return ((data or {}).get("result") or {}).get("message_id")
+
+    async def edit_message(self, message, message_id):
+        self._log.info(f"Edit message {message_id}: {message}")
+        await self._request(
+            EDIT_MESSAGE_METHOD,
+            request_data=dict(
+                message_id=message_id,
+                text=message.text,
+                **{k: v for k, v in message.options.items() if k in EDIT_MESSAGE_OPTIONS},
+            ),
+        )
 
     @contextlib.asynccontextmanager
     async def session(self):
@@ -67,27 +103,67 @@ class TelegramChat:
     async def _request(self, method, request_data):
         if not self._http_client:
             raise RuntimeError("Call requests with in session context manager")
+        remaining = self.flood_wait_remaining()
+        if remaining:
+            # Telegram answers 429 until the flood wait ends, don't spend a request on it
+            raise ProviderFloodWait(f"Flood wait for {remaining:.1f} seconds, {method} is not sent", retry_after=remaining)
 
-        @tenacity.retry(reraise=True, **self._retries_options)
-        async def _call_request_with_retries():
+        attempt = 1
+        while True:
             try:
-                resp = await self._http_client.post(
-                    f"{self.bot_url}/{method}",
-                    data=dict(chat_id=self.chat_id, **request_data),
-                    timeout=self.http_timeout,
-                    allow_redirects=False,
-                )
-                return await self._process_response(resp)
-            except TELEGRAM_TEMPORARY_ERRORS as e:
-                raise ProviderTemporaryError({str(e)}) from e
-            except ProviderError:
+                result = await self._call_request(method, request_data)
+            except ProviderFloodWait as e:
+                # Waiting is up to the caller: a pool can send with another bot
+                self.flood_wait_until = time.monotonic() + e.retry_after
+                self._log.warning(f"Flood wait {e.retry_after} seconds on {method}")
                 raise
-            except Exception as e:
-                raise ProviderFatalError(str(e)) from e
+            except ProviderTemporaryError as e:
+                if attempt >= self._retries_options["attempts"]:
+                    raise self._give_up(e)
+                if not self.retry_budget.try_retry():
+                    self._stat["retries_denied"] += 1
+                    self._log.warning(f"Retry budget is exhausted, give up {method} after attempt {attempt}: {e}")
+                    raise self._give_up(e)
+
+                self._stat["retries"] += 1
+                delay = self._retry_delay(attempt)
+                self._log.warning(f"Retry {method} in {delay:.1f} seconds after attempt {attempt}: {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self.retry_budget.record_success()
+                self._give_ups = 0
+                return result
+
+    def _give_up(self, error):
+        # The caller sends the message again after retry_after, so an outage costs one call per growing delay
+        self._give_ups += 1
+        o = self._retries_options
+        error.retry_after = min(o["wait_max"], max(o["wait_min"], o["wait_multiplier"] * 2**self._give_ups))
+        return error
+
+    async def _call_request(self, method, request_data):
+        try:
+            resp = await self._http_client.post(
+                f"{self.bot_url}/{method}",
+                data=dict(chat_id=self.chat_id, **request_data),
+                timeout=self.http_timeout,
+                allow_redirects=False,
+            )
+            return await self._process_response(resp, method)
+        except TELEGRAM_TEMPORARY_ERRORS as e:
+            raise ProviderTemporaryError({str(e)}) from e
+        except ProviderError:
+            raise
+        except Exception as e:
+            raise ProviderFatalError(str(e)) from e
 
-        return await _call_request_with_retries()
+    def _retry_delay(self, attempt):
+        # Random exponential backoff
+        o = self._retries_options
+        return max(o["wait_min"], random.uniform(0, min(o["wait_max"], o["wait_multiplier"] * 2**attempt)))
 
-    async def _process_response(self, response):
+    async def _process_response(self, response, method=None):
         if response.ok:
             return (response.status, await response.json())
 
@@ -97,6 +173,9 @@ class TelegramChat:
         except aiohttp.ClientConnectionError:
             pass
 
+        if response.status == 429:
+            raise ProviderFloodWait(f"Status: {response.status}. Body: {resp_text}", retry_after=self._parse_retry_after(resp_text))
+
         if (
             response.status >= 400
             and response.status <= 499
@@ -109,4 +188,124 @@ class TelegramChat:
             # {"ok":false,"error_code":400,"description":"Bad Request: not enough rights to send text messages to the chat"}
             raise ProviderFatalError(f"Status: {response.status}. Body: {resp_text}")
 
+        if response.status == 400 and TELEGRAM_MESSAGE_NOT_MODIFIED in resp_text:
+            # Edit with the same text and options is not an error
+            return (response.status, None)
+
+        if response.status == 400 and method == EDIT_MESSAGE_METHOD:
+            # "message to edit not found", "message can't be edited": retries do not help and block the channel
+            raise ProviderFatalError(f"Status: {response.status}. Body: {resp_text}")
+
         raise ProviderTemporaryError(f"Status: {response.status}. Body: {resp_text}")
+
+    def _parse_retry_after(self, resp_text):
+        # {"ok":false,"error_code":429,"description":"Too Many Requests: retry after 35","parameters":{"retry_after":35}}
+        try:
+            return int(json.loads(resp_text)["parameters"]["retry_after"])
+        except (ValueError, TypeError, KeyError):
+            return DEFAULT_FLOOD_WAIT
+
+
+class TelegramBotsPool:
+    """
+    Several bots in the same chat behind the TelegramChat interface.
+
+    Every message is sent by one bot chosen round-robin or least-loaded.
+    Bots in flood wait are skipped. A message is edited by the bot that
+    sent it.
+    """
+
+    strategies = ("round_robin", "least_loaded")
+
+    def __init__(self, bots, strategy="round_robin", sent_messages_cache_size=DEFAULT_POOL_MESSAGES_CACHE_SIZE, logger_name=DEFAULT_LOGGER_NAME, **kwargs):
+        if not bots:
+            raise ValueError("Bots pool is empty")
+        if strategy not in self.strategies:
+            raise ValueError(f'Unknown bots pool strategy "{strategy}". Use one of: {", ".join(self.strategies)}')
+
+        self.bots = list(bots)
+        self.strategy = strategy
+        self.chat_id = self.bots[0].chat_id
+        self.bot_token = self.bots[0].bot_token
+        self.bot_name = self.bots[0].bot_name
+        self.sent_messages_cache_size = int(sent_messages_cache_size)
+
+        self._log = logging.getLogger(f"{logger_name}.pool.{self.chat_id}")
+        self._next_bot = 0
+        # message_id -> index of the bot that sent the message, LRU
+        self._message_bots = collections.OrderedDict()
+        self._bots_stat = [dict(sended=0, errors=0, flood_waits=0, in_flight=0) for _ in self.bots]
+
+    def stat(self):
+        bots = dict()
+        for bot, bot_stat in zip(self.bots, self._bots_stat):
+            bots[bot.bot_name] = bot_stat | bot.stat() | dict(flood_wait=round(bot.flood_wait_remaining(), 3))
+        return dict(
+            retries=sum(b.stat()["retries"] for b in self.bots),
+            retries_denied=sum(b.stat()["retries_denied"] for b in self.bots),
+            bots=bots,
+        )
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        async with contextlib.AsyncExitStack() as stack:
+            for bot in self.bots:
+                await stack.enter_async_context(bot.session())
+            yield self
+
+    async def send_message(self, message):
+        # Every bot is tried at most once: a flood wait switches to the next available bot
+        for _ in self.bots:
+            index = self._choose_bot()
+            try:
+                message_id = await self._call(index, self.bots[index].send_message(message))
+            except ProviderFloodWait:
+                continue
+            self._remember_bot(message_id, index)
+            return message_id
+
+        raise self._pool_flood_wait()
+
+    async def edit_message(self, message, message_id):
+        index = self._message_bots.get(message_id, 0)
+        await self._call(index, self.bots[index].edit_message(message, message_id))
+
+    async def _call(self, index, coro):
+        bot_stat = self._bots_stat[index]
+        bot_stat["in_flight"] += 1
+        try:
+            result = await coro
+        except ProviderFloodWait:
+            bot_stat["flood_waits"] += 1
+            raise
+        except ProviderError:
+            bot_stat["errors"] += 1
+            raise
+        finally:
+            bot_stat["in_flight"] -= 1
+        bot_stat["sended"] += 1
+        return result
+
+    def _choose_bot(self):
+        available = [i for i, bot in enumerate(self.bots) if not bot.flood_wait_remaining()]
+        if not available:
+            raise self._pool_flood_wait()
+
+        if self.strategy == "least_loaded":
+            return min(available, key=lambda i: (self._bots_stat[i]["in_flight"], self._bots_stat[i]["sended"]))
+
+        index = min(available, key=lambda i: (i - self._next_bot) % len(self.bots))
+        self._next_bot = (index + 1) % len(self.bots)
+        return index
+
+    def _pool_flood_wait(self):
+        retry_after = min(bot.flood_wait_remaining() for bot in self.bots)
+        return ProviderFloodWait(f"All bots of the pool are in flood wait for {retry_after:.1f} seconds", retry_after=retry_after)
+
+    def _remember_bot(self, message_id, index):
+        if message_id is None:
+            return
+        self._message_bots[message_id] = index
+        self._message_bots.move_to_end(message_id)
+        if len(self._message_bots) > self.sent_messages_cache_size:
+            self._message_bots.popitem(last=False)
@@ -1,10 +1,19 @@
 import asyncio
+import collections
+import glob
 import logging
+import os
+import pickle
+import struct
+import sys
 
 import tgproxy.errors as errors
 
 DEFAULT_LOGGER_NAME = "tgproxy.queue.memory"
 DEFAULT_QUEUE_MAXSIZE = 10000
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+SEGMENT_FILE_SUFFIX = ".seg"
+RECORD_HEADER = struct.Struct(">I")
 
 
 class BaseQueue:  # pragma: no cover
@@ -17,28 +26,300 @@ class BaseQueue:  # pragma: no cover
     async def dequeue(self):
         raise NotImplementedError()
 
+    async def task_done(self):
+        raise NotImplementedError()
+
+    def head(self):
+        raise NotImplementedError()
+
+    def __iter__(self):
+        raise NotImplementedError()
+
+    def mark_cancelled(self):
+        raise NotImplementedError()
+
+    def drop_cancelled(self):
+        raise NotImplementedError()
+
+    def charge(self, message):
+        raise NotImplementedError()
+
+    def release(self, message):
+        raise NotImplementedError()
+
     async def regain(self, message):
         raise NotImplementedError()
 
 
+class MemoryBudget:
+    # Memory limit in bytes shared by queues. maxbytes=None is unlimited
+    def __init__(self, maxbytes=None):
+        self.maxbytes = maxbytes
+        self.used = 0
+
+    def exceeded(self, extra=0):
+        return self.maxbytes is not None and self.used + extra > self.maxbytes
+
+    def charge(self, size):
+        self.used += size
+
+    def release(self, size):
+        self.used -= size
+
+    def stat(self):
+        return dict(maxbytes=self.maxbytes, used=self.used)
+
+
+DEFAULT_MEMORY_BUDGET = MemoryBudget()
+# Directory for queue spill segments. Queues without a spill directory reject messages over the byte limits
+DEFAULT_SPILL_DIR = None
+
+
+def message_size(message):
+    # Approximate memory held by a queued message
+    if hasattr(message, "size"):
+        return message.size()
+    return sys.getsizeof(message)
+
+
+class SpillFile:
+    """
+    FIFO of pickled messages in append-only segment files.
+
+    Records are written to the last segment and read from the first one.
+    A segment is deleted as soon as it is read to the end. Spilled messages
+    do not survive a restart: stale segments are removed on start.
+    """
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE, logger_name=DEFAULT_LOGGER_NAME):
+        self.path = path
+        self.segment_size = segment_size
+        self.count = 0
+
+        self._log = logging.getLogger(logger_name)
+        self._segments = collections.deque()
+        self._next_segment = 0
+        self._write_file = None
+        self._read_file = None
+        self._head = None
+        self._remove_stale_segments()
+
+    def append(self, messages):
+        if self._write_file is None or self._write_file.tell() >= self.segment_size:
+            self._open_write_segment()
+        for message in messages:
+            data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+            self._write_file.write(RECORD_HEADER.pack(len(data)))
+            self._write_file.write(data)
+            self.count += 1
+        self._write_file.flush()
+
+    def peek(self):
+        if self._head is None and self.count:
+            self._head = self._read_record()
+        return self._head
+
+    def pop(self):
+        message = self.peek()
+        self._head = None
+        self.count -= 1
+        if not self.count:
+            # Everything is read: drop the segments instead of waiting for the end of the file
+            self.close()
+        return message
+
+    def __iter__(self):
+        # Reads the queued records from the head without consuming them
+        remaining = self.count
+        if self._head is not None:
+            yield self._head
+            remaining -= 1
+        for i, segment in enumerate(list(self._segments)):
+            with open(segment, "rb") as f:
+                if i == 0 and self._read_file is not None:
+                    f.seek(self._read_file.tell())
+                while remaining:
+                    header = f.read(RECORD_HEADER.size)
+                    if not header:
+                        break
+                    yield pickle.loads(f.read(RECORD_HEADER.unpack(header)[0]))
+                    remaining -= 1
+
+    def close(self):
+        for f in (self._read_file, self._write_file):
+            if f is not None:
+                f.close()
+        self._read_file = self._write_file = None
+        for segment in self._segments:
+            os.remove(segment)
+        self._segments.clear()
+        self.count = 0
+        self._head = None
+
+    def _remove_stale_segments(self):
+        os.makedirs(self.path, exist_ok=True)
+        stale = glob.glob(os.path.join(self.path, f"*{SEGMENT_FILE_SUFFIX}"))
+        if stale:
+            self._log.warning(f"Remove {len(stale)} stale spill segments from {self.path}")
+        for segment in stale:
+            os.remove(segment)
+
+    def _open_write_segment(self):
+        if self._write_file is not None:
+            self._write_file.close()
+        segment = os.path.join(self.path, f"{self._next_segment:012d}{SEGMENT_FILE_SUFFIX}")
+        self._next_segment += 1
+        self._segments.append(segment)
+        self._write_file = open(segment, "wb")
+
+    def _read_record(self):
+        while True:
+            if self._read_file is None:
+                self._read_file = open(self._segments[0], "rb")
+            header = self._read_file.read(RECORD_HEADER.size)
+            if header:
+                return pickle.loads(self._read_file.read(RECORD_HEADER.unpack(header)[0]))
+
+            # The segment is read to the end, the next one is in the order of writing
+            self._read_file.close()
+            self._read_file = None
+            if self._segments[0] == self._write_segment():
+                self._write_file.close()
+                self._write_file = None
+            os.remove(self._segments.popleft())
+
+    def _write_segment(self):
+        return self._segments[-1] if self._write_file is not None else None
+
+
 class MemoryQueue(BaseQueue):
-    def __init__(self, maxsize=None, logger_name=DEFAULT_LOGGER_NAME):
-        self._queue = asyncio.Queue(maxsize=maxsize or DEFAULT_QUEUE_MAXSIZE)
+    """
+    FIFO queue limited by the number of messages and by bytes.
+
+    Bytes are limited per queue (maxbytes) and by the memory budget shared
+    with other queues. Over the limits the oldest messages are moved to the
+    spill file and read back in order, so the spilled part is always the
+    head of the queue. With a spill directory maxsize limits the messages
+    in memory only and the spilled part is limited by the disk. Without it
+    the queue rejects messages over the limits.
+    """
+
+    def __init__(self, maxsize=None, maxbytes=None, budget=None, spill_dir=None, logger_name=DEFAULT_LOGGER_NAME):
+        self.maxsize = maxsize or DEFAULT_QUEUE_MAXSIZE
+        self.maxbytes = maxbytes
+        self._budget = budget or MemoryBudget()
+        self._spill = SpillFile(spill_dir, logger_name=logger_name) if spill_dir else None
         self._log = logging.getLogger(logger_name)
 
+        # (message, size) of the queue tail in memory
+        self._memory = collections.deque()
+        self._memory_bytes = 0
+        self._not_empty = asyncio.Event()
+        # Queued entries the consumer will drop unsent. They do not take place in the queue
+        self._cancelled = 0
+        self._stat = dict(
+            spilled=0,
+        )
+
     def qsize(self):
-        return self._queue.qsize()
+        return len(self._memory) + (self._spill.count if self._spill else 0)
+
+    def stat(self):
+        return dict(
+            memory_bytes=self._memory_bytes,
+            disk_size=self._spill.count if self._spill else 0,
+            spilled=self._stat["spilled"],
+        )
 
     async def enqueue(self, message):
-        try:
-            # Кладем очередь без блокировок на ожидании особождения места в очереди
-            self._log.info(f"Enque message {message}")
-            self._queue.put_nowait(message)
-        except asyncio.QueueFull:
-            raise errors.QueueFull(f"Queue is full. Max size is {self._queue.maxsize}")
+        # Кладем очередь без блокировок на ожидании особождения места в очереди
+        self._log.info(f"Enque message {message}")
+        if self._spill is None and self.qsize() - self._cancelled >= self.maxsize:
+            raise errors.QueueFull(f"Queue is full. Max size is {self.maxsize}")
+
+        size = message_size(message)
+        if self._over_limits(size):
+            if self._spill is None:
+                raise errors.QueueFull(f"Queue is full. Max size is {self.maxbytes or self._budget.maxbytes} bytes")
+            self._spill_oldest(size)
+
+        if self._over_limits(size):
+            # Other queues hold the budget: the message goes to disk after the spilled head
+            self._spill.append([message])
+            self._stat["spilled"] += 1
+        else:
+            self._memory.append((message, size))
+            self._memory_bytes += size
+            self._budget.charge(size)
+        self._not_empty.set()
 
     async def dequeue(self):
-        return await self._queue.get()
+        while not self.qsize():
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        if self._spill and self._spill.count:
+            return self._spill.pop()
+
+        message, size = self._memory.popleft()
+        self._memory_bytes -= size
+        self._budget.release(size)
+        return message
 
     async def task_done(self):
-        self._queue.task_done()
+        pass
+
+    def head(self):
+        # The oldest queued message or None
+        if self._spill and self._spill.count:
+            return self._spill.peek()
+        return self._memory[0][0] if self._memory else None
+
+    def __iter__(self):
+        # Queued messages from the oldest one. Spilled messages are read from disk as copies
+        if self._spill:
+            yield from self._spill
+        for message, _ in self._memory:
+            yield message
+
+    def mark_cancelled(self):
+        self._cancelled += 1
+
+    def drop_cancelled(self):
+        # The consumer dequeued a cancelled entry
+        self._cancelled -= 1
+
+    def charge(self, message):
+        # Counts a message held by the consumer outside of the queue, e.g. a replacement of a queued one
+        size = message_size(message)
+        if self._over_limits(size, entries=0):
+            if self._spill is None:
+                raise errors.QueueFull(f"Queue is full. Max size is {self.maxbytes or self._budget.maxbytes} bytes")
+            self._spill_oldest(size, entries=0)
+        self._memory_bytes += size
+        self._budget.charge(size)
+
+    def release(self, message):
+        size = message_size(message)
+        self._memory_bytes -= size
+        self._budget.release(size)
+
+    def _over_limits(self, size, entries=1):
+        return (
+            (self._spill is not None and len(self._memory) + entries > self.maxsize)
+            or (self.maxbytes is not None and self._memory_bytes + size > self.maxbytes)
+            or self._budget.exceeded(size)
+        )
+
+    def _spill_oldest(self, size, entries=1):
+        spilled = list()
+        while self._memory and self._over_limits(size, entries):
+            message, message_size_ = self._memory.popleft()
+            self._memory_bytes -= message_size_
+            self._budget.release(message_size_)
+            spilled.append(message)
+
+        if spilled:
+            self._log.info(f"Spill {len(spilled)} messages to {self._spill.path}")
+            self._spill.append(spilled)
+            self._stat["spilled"] += len(spilled)
@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import pickle
+import sys
+import time
+
+import tgproxy.errors as errors
+
+DEFAULT_LOGGER_NAME = "tgproxy.scheduler"
+# Delay before the next attempt to put a due message into a full queue
+DEFAULT_QUEUE_FULL_DELAY = 1.0
+# Due messages released between yields to the event loop
+RELEASE_BATCH_SIZE = 1000
+DEFAULT_SCHEDULER_MAXSIZE = 100000
+
+
+class Scheduler:
+    """
+    Holds messages with send_at in the future and puts them into their
+    channels when they are due.
+
+    Messages are kept pickled in a heap ordered by send_at. One task sleeps
+    until the earliest send_at and releases all due messages at once, so
+    the event loop is not woken up per message. A due message that does not
+    fit the channel queue is put again after queue_full_delay seconds.
+    Scheduled messages are kept in memory only and are lost on restart.
+    Past maxsize messages or maxbytes of pickled messages new ones are
+    rejected with QueueFull.
+    """
+
+    def __init__(self, maxsize=DEFAULT_SCHEDULER_MAXSIZE, maxbytes=None, queue_full_delay=DEFAULT_QUEUE_FULL_DELAY, logger_name=DEFAULT_LOGGER_NAME):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.queue_full_delay = queue_full_delay
+
+        self._log = logging.getLogger(logger_name)
+        # (send_at, sequence number, channel, pickled message)
+        self._heap = list()
+        self._bytes = 0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stat = dict(
+            released=0,
+            delayed=0,
+            failed=0,
+        )
+
+    def __len__(self):
+        return len(self._heap)
+
+    def stat(self):
+        return dict(
+            scheduled=len(self._heap),
+            next_send_at=self._heap[0][0] if self._heap else None,
+            bytes=self._bytes,
+            maxsize=self.maxsize,
+            maxbytes=self.maxbytes,
+            **self._stat,
+        )
+
+    def schedule(self, channel, message):
+        if self.maxsize is not None and len(self._heap) >= self.maxsize:
+            raise errors.QueueFull(f"Scheduler is full. Max size is {self.maxsize}")
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.maxbytes is not None and self._bytes + len(payload) > self.maxbytes:
+            raise errors.QueueFull(f"Scheduler is full. Max size is {self.maxbytes} bytes")
+        self._push(message.send_at, channel, payload)
+
+    async def start(self, app=None):
+        self._task = asyncio.create_task(self.run(), name="scheduler")
+
+    async def stop(self, app=None):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._heap:
+            self._log.warning(f"Drop {len(self._heap)} scheduled messages")
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._release(time.time())
+            await asyncio.sleep(0)
+
+    def _push(self, send_at, channel, payload):
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (send_at, next(self._seq), channel, payload))
+        self._bytes += len(payload)
+        if earliest is None or send_at < earliest:
+            # The sleeping task waits for a later message
+            self._wakeup.set()
+
+    async def _release(self, now):
+        delayed = list()
+        for _ in range(RELEASE_BATCH_SIZE):
+            if not self._heap or self._heap[0][0] > now:
+                break
+            _, _, channel, payload = heapq.heappop(self._heap)
+            self._bytes -= len(payload)
+            try:
+                await channel.put(pickle.loads(payload))
+                self._stat["released"] += 1
+            except errors.QueueFull:
+                delayed.append((channel, payload))
+            except Exception as e:
+                self._stat["failed"] += 1
+                self._log.error(f"Can't put scheduled message to {channel.name}: {e}", exc_info=sys.exc_info())
+
+        if delayed:
+            self._log.warning(f"Queue is full, delay {len(delayed)} scheduled messages for {self.queue_full_delay} seconds")
+            self._stat["delayed"] += len(delayed)
+        for channel, payload in delayed:
+            self._push(now + self.queue_full_delay, channel, payload)
+
+
+DEFAULT_SCHEDULER = Scheduler()
@@ -0,0 +1,113 @@
+import html
+import json
+import re
+import string
+
+import tgproxy.errors as errors
+
+MARKDOWN_V2_SPECIAL_CHARS = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+MARKDOWN_SPECIAL_CHARS = re.compile(r"([_*`\[\\])")
+
+# parse_mode -> escape function for template variables
+ESCAPERS = {
+    None: lambda v: v,
+    "HTML": html.escape,
+    "MarkdownV2": lambda v: MARKDOWN_V2_SPECIAL_CHARS.sub(r"\\\1", v),
+    "Markdown": lambda v: MARKDOWN_SPECIAL_CHARS.sub(r"\\\1", v),
+}
+
+
+class Template:
+    """
+    A message template with {name} placeholders.
+
+    The text is parsed once, when the template is created. Rendering joins
+    the literal chunks with formatted variables escaped for the parse_mode.
+    """
+
+    def __init__(self, name, text, parse_mode=None):
+        self.name = name
+        self.text = text
+        self.parse_mode = parse_mode
+        self._parts = self._compile(text)
+        self.fields = frozenset(p[0] for p in self._parts if isinstance(p, tuple))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name="{self.name}", parse_mode={self.parse_mode}, fields={sorted(self.fields)})'
+
+    def validate(self, variables, parse_mode=None):
+        # Cheap checks on ingest, so rendering in the worker does not fail on missing variables
+        if parse_mode not in ESCAPERS:
+            raise errors.TemplateError(f'Unknown parse_mode "{parse_mode}"')
+        missing = self.fields.difference(variables)
+        if missing:
+            raise errors.TemplateError(f'Template "{self.name}" variables are not set: {", ".join(sorted(missing))}')
+
+    def render(self, variables, parse_mode=None):
+        escaper = ESCAPERS.get(parse_mode)
+        if escaper is None:
+            raise errors.TemplateError(f'Unknown parse_mode "{parse_mode}"')
+
+        chunks = list()
+        try:
+            for part in self._parts:
+                if isinstance(part, str):
+                    chunks.append(part)
+                    continue
+                field, conversion, format_spec = part
+                value = variables[field]
+                if conversion:
+                    value = repr(value) if conversion == "r" else str(value)
+                chunks.append(escaper(format(value, format_spec)))
+        except KeyError as e:
+            raise errors.TemplateError(f'Template "{self.name}" variable {e} is not set')
+        except (TypeError, ValueError) as e:
+            raise errors.TemplateError(f'Template "{self.name}" render failed: {e}')
+        return "".join(chunks)
+
+    def _compile(self, text):
+        parts = list()
+        try:
+            for literal, field, format_spec, conversion in string.Formatter().parse(text):
+                if literal:
+                    parts.append(literal)
+                if field is None:
+                    continue
+                if not field.isidentifier():
+                    raise errors.TemplateError(f'Template "{self.name}" has bad placeholder "{{{field}}}"')
+                parts.append((field, conversion, format_spec or ""))
+        except ValueError as e:
+            raise errors.TemplateError(f'Template "{self.name}" has bad format: {e}')
+        return parts
+
+
+class TemplatesRegistry:
+    # Named templates. Templates not found here are looked up in the parent registry.
+    def __init__(self, templates=None, parent=None):
+        self.parent = parent
+        self._templates = dict()
+        for template in templates or []:
+            self.add(template)
+
+    def __len__(self):
+        return len(self._templates)
+
+    def add(self, template):
+        self._templates[template.name] = template
+
+    def get(self, name):
+        template = self._templates.get(name)
+        if template is None and self.parent is not None:
+            return self.parent.get(name)
+        if template is None:
+            raise errors.TemplateError(f'Template "{name}" not found')
+        return template
+
+    def load_file(self, path):
+        # JSON file: {"name": {"text": "Hello, {name}", "parse_mode": "HTML"}}
+        with open(path, encoding="utf-8") as f:
+            for name, options in json.load(f).items():
+                self.add(Template(name, **options))
+
+
+GLOBAL_TEMPLATES = TemplatesRegistry()
@@ -11,3 +11,13 @@ def parse_url(url):
             urllib.parse.parse_qsl(parsed_url.query),
         )
     return (parsed_url, options)
+
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(value):
+    # Bytes from "1048576", "512K", "64M", "1G"
+    value = str(value).strip().upper().removesuffix("B")
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ""
+    return int(float(value[: len(value) - len(unit)]) * SIZE_UNITS[unit])